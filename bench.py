@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# Benchmarks for the func-nagios module.
+#
+# These run offline. certmaster and func aren't needed, minimal
+# stand-ins are installed in their place before the module is
+# imported, and commands are written to a local FIFO drained by a
+# stand-in reader process instead of a real Nagios.
+#
+# usage: python bench.py [--json] [--sizes 1,100,10000,100000]
+#
+# Each benchmark runs once per size (number of targets) and reports
+# throughput and per-call latency percentiles. --json prints the
+# results as JSON instead of a table, for tracking regressions.
+
+from __future__ import print_function
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import types
+
+timer = timeit.default_timer
+
+
+def install_stubs():
+    """
+    Install just enough of certmaster.config and func_module for
+    src/nagios.py to import and instantiate
+    """
+
+    config = types.ModuleType("certmaster.config")
+
+    class Option(object):
+        def __init__(self, default=None):
+            self.default = default
+
+    class BaseConfig(object):
+        pass
+
+    config.Option = Option
+    config.BoolOption = Option
+    config.IntOption = Option
+    config.FloatOption = Option
+    config.ListOption = Option
+    config.BaseConfig = BaseConfig
+
+    certmaster = types.ModuleType("certmaster")
+    certmaster.config = config
+
+    func_module = types.ModuleType("func_module")
+
+    class FuncModule(object):
+        def __init__(self):
+            self.options = self.Config()
+            for name in dir(self.Config):
+                option = getattr(self.Config, name)
+                if isinstance(option, Option):
+                    setattr(self.options, name, option.default)
+
+    func_module.FuncModule = FuncModule
+
+    sys.modules["certmaster"] = certmaster
+    sys.modules["certmaster.config"] = config
+    sys.modules["func_module"] = func_module
+
+
+def read_fifo(path, results):
+    """
+    Stand-in for Nagios: drain the FIFO until every writer closes it,
+    then report how many lines and bytes were read
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    lines = 0
+    size = 0
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        lines += data.count(b"\n")
+        size += len(data)
+    os.close(fd)
+    results.put((lines, size))
+
+
+def percentile(latencies, q):
+    return latencies[int(q * (len(latencies) - 1))]
+
+
+def summarize(name, targets, seconds, latencies, lines):
+    """
+    Build a result record. latencies are per-call, in seconds.
+    """
+
+    latencies = sorted(latencies)
+    return {"bench": name,
+            "targets": targets,
+            "lines": lines,
+            "seconds": seconds,
+            "lines_per_second": seconds and lines / seconds or 0,
+            "p50_us": percentile(latencies, 0.50) * 1e6,
+            "p90_us": percentile(latencies, 0.90) * 1e6,
+            "p99_us": percentile(latencies, 0.99) * 1e6,
+            "max_us": latencies[-1] * 1e6}
+
+
+def time_calls(calls):
+    """
+    Call each function in calls, returning the total and per-call
+    times
+    """
+
+    latencies = []
+    start = timer()
+    for call in calls:
+        t = timer()
+        call()
+        latencies.append(timer() - t)
+    return timer() - start, latencies
+
+
+def bench_format(n, targets):
+    results = []
+
+    calls = [lambda: n._fmt_dt_str("SCHEDULE_SVC_DOWNTIME", "www01", 30,
+                                   svc="HTTP")] * targets
+    seconds, latencies = time_calls(calls)
+    results.append(summarize("_fmt_dt_str", targets, seconds, latencies,
+                             targets))
+
+    calls = [lambda: n._fmt_notif_str("DISABLE_SVC_NOTIFICATIONS", "www01",
+                                      svc="HTTP")] * targets
+    seconds, latencies = time_calls(calls)
+    results.append(summarize("_fmt_notif_str", targets, seconds, latencies,
+                             targets))
+
+    return results
+
+
+def with_reader(nagios, n, workdir, run):
+    """
+    Point the module at a fresh FIFO drained by a reader process, call
+    run(), and check the reader saw every line. Returns what run()
+    returned and the number of lines read.
+    """
+
+    path = os.path.join(workdir, "nagios.cmd")
+    if os.path.exists(path):
+        os.unlink(path)
+    os.mkfifo(path)
+
+    queue = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=read_fifo, args=(path, queue))
+    reader.start()
+
+    n._transport = nagios.CommandPipe(path, 5.0)
+    # Open the FIFO before timing anything, so the numbers don't
+    # include waiting for the reader process to start
+    n._transport._open(time.time() + 5.0)
+    try:
+        result = run()
+    finally:
+        n._transport.close()
+
+    lines, size = queue.get()
+    reader.join()
+    return result, lines
+
+
+def bench_write(nagios, n, workdir, targets):
+    results = []
+    cmds = [n._fmt_dt_str("SCHEDULE_SVC_DOWNTIME", "www%05d" % i, 30,
+                          svc="HTTP") for i in range(targets)]
+
+    # One write per command, the way every method used to work
+    calls = [lambda cmd=cmd: n._write_command(cmd) for cmd in cmds]
+    (seconds, latencies), lines = with_reader(
+        nagios, n, workdir, lambda: time_calls(calls))
+    check_lines("_write_command", targets, lines)
+    results.append(summarize("_write_command", targets, seconds, latencies,
+                             lines))
+
+    # The whole batch in PIPE_BUF sized chunks
+    (seconds, latencies), lines = with_reader(
+        nagios, n, workdir,
+        lambda: time_calls([lambda: n._write_commands(cmds)]))
+    check_lines("_write_commands", targets, lines)
+    results.append(summarize("_write_commands", targets, seconds, latencies,
+                             lines))
+
+    return results
+
+
+def check_lines(name, expected, lines):
+    if lines != expected:
+        sys.exit("%s: reader saw %d lines, expected %d" %
+                 (name, lines, expected))
+
+
+def print_table(results):
+    print("%-16s %8s %10s %12s %9s %9s %9s %9s" %
+          ("bench", "targets", "seconds", "lines/s",
+           "p50 us", "p90 us", "p99 us", "max us"))
+    for r in results:
+        print("%-16s %8d %10.4f %12.0f %9.1f %9.1f %9.1f %9.1f" %
+              (r["bench"], r["targets"], r["seconds"],
+               r["lines_per_second"], r["p50_us"], r["p90_us"],
+               r["p99_us"], r["max_us"]))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [--json] [--sizes N,N,...]")
+    parser.add_option("--json", action="store_true", default=False,
+                      help="print the results as JSON")
+    parser.add_option("--sizes", default="1,100,10000,100000",
+                      help="comma separated numbers of targets")
+    opts, args = parser.parse_args()
+    sizes = [int(size) for size in opts.sizes.split(",")]
+
+    install_stubs()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "src"))
+    import nagios
+
+    n = nagios.Nagios()
+    n.options.validate_targets = False
+
+    workdir = tempfile.mkdtemp(prefix="func-nagios-bench-")
+    results = []
+    try:
+        for size in sizes:
+            results.extend(bench_format(n, size))
+            results.extend(bench_write(nagios, n, workdir, size))
+    finally:
+        shutil.rmtree(workdir)
+
+    if opts.json:
+        print(json.dumps({"python": platform.python_version(),
+                          "pipe_buf": nagios.PIPE_BUF,
+                          "results": results}, indent=2, sort_keys=True))
+    else:
+        print_table(results)
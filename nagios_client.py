@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# Overlord side helper for driving the func-nagios module on many Nagios
+# servers at once.
+#
+# Calls are queued per Nagios server, then sent as one func async job
+# per server (using the module's `batch` method) so every server works
+# at the same time. The jobs are polled with backoff until they finish,
+# and the results can be read per server or per target.
+#
+#     from nagios_client import NagiosFanout
+#
+#     fanout = NagiosFanout()
+#     fanout.add("nagios1.example.com", "schedule_host_downtime", "www01", 60)
+#     fanout.add("nagios2.example.com", "schedule_downtime_bulk",
+#                {"db01": [], "db02": ["mysql"]}, 60)
+#     fanout.run()
+#     print fanout.by_target()
+#
+# usage: python nagios_client.py [OPERATIONS.json]
+#
+# From the command line it reads a JSON list of [server, method, arg,
+# ...] operations from the file, or standard input, runs them and
+# prints the results by target as JSON.
+
+from __future__ import print_function
+
+import json
+import sys
+import time
+
+import func.overlord.client as fc
+from func import jobthing
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Methods returning a dict of results by host
+BULK_METHODS = set(["schedule_downtime_bulk", "disable_notifications_bulk",
+                    "enable_notifications_bulk", "schedule_host_tree_downtime",
+                    "submit_check_results", "restore_notification_state"])
+
+
+class NagiosFanout(object):
+    """
+    Runs Nagios module calls on many Nagios servers in parallel.
+
+    poll_interval - Seconds to wait before the first job status check.
+      The wait grows by half each round, up to max_interval.
+    client - Factory for func clients, called with the server name.
+      Defaults to an async fc.Client.
+    """
+
+    def __init__(self, poll_interval=0.5, max_interval=5.0, client=None):
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        if client is None:
+            # async is a reserved word in newer Pythons
+            client = lambda server: fc.Client(server, **{"async": True})
+        self.client = client
+        # server -> [(method, args), ...] in the order they were added
+        self.operations = {}
+        # server -> [result, ...], matching self.operations
+        self.results = {}
+
+    def add(self, server, method, *args):
+        """
+        Queue a call of a Nagios module method on a server.
+        """
+
+        self.operations.setdefault(server, []).append((method, args))
+
+    def run(self, timeout=600):
+        """
+        Send the queued calls, one async job per server, and wait up to
+        timeout seconds for them all to finish. Calls on servers whose
+        jobs fail or don't finish in time get a "Fail:" result. A
+        server whose job status can't be checked is retried until the
+        timeout, without holding up the others.
+
+        Returns a dict mapping each server to the list of results of
+        its calls, in the order they were added.
+        """
+
+        jobs = {}
+        for server, operations in self.operations.items():
+            batch = [[method] + list(args) for method, args in operations]
+            try:
+                jobs[server] = self.client(server).nagios.batch(batch)
+            except Exception as e:
+                self._fail(server, "Fail: could not start job: %s" % e)
+
+        deadline = time.time() + timeout
+        interval = self.poll_interval
+        # server -> the error from its last failed job status check
+        errors = {}
+        while jobs:
+            time.sleep(max(0, min(interval, deadline - time.time())))
+            for server, job_id in list(jobs.items()):
+                try:
+                    code, results = self.client(server).job_status(job_id)
+                except Exception as e:
+                    # Maybe a passing network error, keep trying until
+                    # the deadline
+                    errors[server] = e
+                    continue
+                if code in (jobthing.JOB_ID_RUNNING,
+                            jobthing.JOB_ID_ASYNC_PARTIAL):
+                    continue
+                del jobs[server]
+                if code in (jobthing.JOB_ID_FINISHED,
+                            jobthing.JOB_ID_ASYNC_FINISHED):
+                    self._finish(server, results)
+                else:
+                    self._fail(server, "Fail: job %s was lost (%s)" %
+                               (job_id, code))
+            if jobs and time.time() >= deadline:
+                for server, job_id in jobs.items():
+                    if server in errors:
+                        self._fail(server, "Fail: could not check job %s: %s"
+                                   % (job_id, errors[server]))
+                    else:
+                        self._fail(server, "Fail: timed out waiting for "
+                                   "job %s" % job_id)
+                break
+            interval = min(interval * 1.5, self.max_interval)
+
+        return self.results
+
+    def _finish(self, server, results):
+        """
+        Record a finished job's results, which func returns as a dict
+        of minion -> return value.
+        """
+
+        result = results.get(server)
+        if result is None and len(results) == 1:
+            result = list(results.values())[0]
+        operations = self.operations[server]
+        if isinstance(result, list) and len(result) == len(operations):
+            self.results[server] = result
+        else:
+            # A remote exception comes back as a list of strings
+            self._fail(server, "Fail: %r" % (result,))
+
+    def _fail(self, server, message):
+        self.results[server] = [message] * len(self.operations[server])
+
+    def by_target(self):
+        """
+        Regroup the results of `run` by target. The results of bulk
+        methods, which are dicts by host, are split up by host. Any
+        other call's target is its first argument.
+
+        Returns a dict mapping each target to a list of [server,
+        method, result] for every call that touched it.
+        """
+
+        targets = {}
+        for server, operations in self.operations.items():
+            for (method, args), result in zip(operations,
+                                              self.results.get(server, [])):
+                if method in BULK_METHODS and isinstance(result, dict) and \
+                        "results_id" not in result:
+                    for target, target_result in result.items():
+                        targets.setdefault(target, []).append(
+                            [server, method, target_result])
+                else:
+                    target = args and args[0] or ""
+                    if not isinstance(target, string_types):
+                        target = ""
+                    targets.setdefault(target, []).append(
+                        [server, method, result])
+        return targets
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        fp = open(sys.argv[1])
+    else:
+        fp = sys.stdin
+    fanout = NagiosFanout()
+    for operation in json.load(fp):
+        fanout.add(*operation)
+    fanout.run()
+    print(json.dumps(fanout.by_target(), indent=2, sort_keys=True))
@@ -0,0 +1,754 @@
+#!/usr/bin/env python
+# A stand-in for Nagios' end of the external command file, for testing
+# the func-nagios module without a real Nagios.
+#
+# usage: python nagios_sim.py serve --fifo PATH [--status PATH] [faults]
+#        python nagios_sim.py load [--calls N] [--threads N] [--json] [faults]
+#        python nagios_sim.py livestatus [--hosts N]
+#
+# serve creates the FIFO and consumes it the way Nagios does until
+# interrupted, then prints what it saw. With --status it also writes a
+# status.dat with the simulated downtime and notification state, so
+# the module's status.dat readers can be pointed at it.
+#
+# load does the same on a temporary FIFO while calling every public
+# method of the module that sends commands, and reports per-method
+# call latency, end-to-end latency (until the simulator has read every
+# line the call wrote) and throughput. It then hammers the module from
+# several threads at once. The exit status is 1 if any line arrived
+# torn or interleaved, or if lines went missing without a fault to
+# explain it.
+#
+# livestatus checks the Livestatus transport against a stand-in
+# Livestatus listener: that connections are pooled, that a bulk call
+# is pipelined down one connection, that the transport reconnects
+# when the listener drops its connections or restarts, and that a
+# send failing part way doesn't send any command twice. It prints
+# each check and exits 1 if any of them failed.
+#
+# Faults, for serve and load:
+#   --slow SECONDS         sleep this long between small reads
+#   --restart-every SECS   close and reopen the FIFO this often, like
+#                          a Nagios restart, for --restart-for seconds
+#   --stall-every SECS     stop reading this often, for --stall-for
+#                          seconds, so the pipe fills up
+
+from __future__ import print_function
+
+import errno
+import json
+import optparse
+import os
+import re
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from bench import install_stubs, percentile
+
+timer = timeit.default_timer
+
+LINE_RE = re.compile(r"^\[(\d+)\] ([A-Z_]+)(?:;(.*))?$")
+
+# Arguments Nagios expects to be integers
+INT_PARAMS = set(["start_time", "end_time", "fixed", "trigger_id",
+                  "duration", "downtime_id", "sticky", "notify",
+                  "persistent", "comment_id", "check_time",
+                  "status_code", "return_code"])
+
+
+class SimulatedNagios(object):
+    """
+    Parses command lines and keeps the state a real Nagios would:
+    downtime, notification flags and acknowledgements.
+
+    commands - The module's command registry, used to name each
+      command's arguments
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.cond = threading.Condition()
+        self.lines = 0
+        self.counts = {}
+        self.torn = []
+        self.unknown = []
+        self.downtimes = {}
+        self.next_downtime_id = 1
+        self.notifications = True
+        self.host_notifications = {}
+        self.svc_notifications = {}
+        self.acks = set()
+        self.host_services = {}
+
+    def parse(self, line):
+        """
+        Split a command line into (entry_time, command, {param:
+        value}). Returns None if the line is malformed, which for
+        lines written by the module means it was torn or interleaved
+        with another writer's.
+        """
+
+        match = LINE_RE.match(line)
+        if match is None:
+            return None
+        entry_time, name, rest = match.groups()
+        command = self.commands.get(name)
+        if command is None:
+            return int(entry_time), name, None
+
+        params = command.params
+        if params:
+            if rest is None:
+                return None
+            # The last argument (a comment or plugin output) may
+            # contain semicolons
+            values = rest.split(";", len(params) - 1)
+        else:
+            if rest is not None:
+                return None
+            values = []
+        if len(values) != len(params):
+            return None
+        for param, value in zip(params, values):
+            if param in INT_PARAMS and not re.match(r"^-?\d+$", value):
+                return None
+        return int(entry_time), name, dict(zip(params, values))
+
+    def process(self, line):
+        self.cond.acquire()
+        try:
+            parsed = self.parse(line)
+            if parsed is None:
+                self.torn.append(line)
+            else:
+                entry_time, name, args = parsed
+                if args is None:
+                    self.unknown.append(line)
+                else:
+                    self.counts[name] = self.counts.get(name, 0) + 1
+                    self._apply(entry_time, name, args)
+            self.lines += 1
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _apply(self, entry_time, name, args):
+        host = args.get("host_name")
+        service = args.get("service_description")
+        if host is not None:
+            services = self.host_services.setdefault(host, set())
+            if service is not None:
+                services.add(service)
+
+        if name.startswith("SCHEDULE_") and name.endswith("_DOWNTIME"):
+            downtime = dict(args)
+            downtime["command"] = name
+            downtime["entry_time"] = entry_time
+            # status.dat calls the trigger triggered_by
+            downtime["triggered_by"] = downtime.pop("trigger_id", 0)
+            downtime["downtime_id"] = self.next_downtime_id
+            self.downtimes[self.next_downtime_id] = downtime
+            self.next_downtime_id += 1
+        elif name in ("DEL_HOST_DOWNTIME", "DEL_SVC_DOWNTIME"):
+            self.downtimes.pop(int(args["downtime_id"]), None)
+        elif name in ("ENABLE_NOTIFICATIONS", "DISABLE_NOTIFICATIONS"):
+            self.notifications = name.startswith("ENABLE_")
+        elif name.endswith("_HOST_NOTIFICATIONS") and host is not None:
+            self.host_notifications[host] = name.startswith("ENABLE_")
+        elif name.endswith("_HOST_SVC_NOTIFICATIONS"):
+            for svc in self.host_services[host]:
+                self.svc_notifications[(host, svc)] = \
+                    name.startswith("ENABLE_")
+        elif name.endswith("_SVC_NOTIFICATIONS") and service is not None:
+            self.svc_notifications[(host, service)] = \
+                name.startswith("ENABLE_")
+        elif name.startswith("ACKNOWLEDGE_"):
+            self.acks.add((host, service))
+        elif name.startswith("REMOVE_") and name.endswith("_ACKNOWLEDGEMENT"):
+            self.acks.discard((host, service))
+
+    def wait_for(self, lines, timeout):
+        """
+        Wait until at least `lines` lines have been read. Returns
+        False on timeout.
+        """
+
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while self.lines < lines:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+        finally:
+            self.cond.release()
+
+    def write_status(self, path):
+        """
+        Write the simulated state out in status.dat format.
+        """
+
+        self.cond.acquire()
+        try:
+            blocks = []
+            for host in sorted(self.host_services):
+                blocks.append(("hoststatus", [
+                    ("host_name", host),
+                    ("notifications_enabled",
+                     int(self.host_notifications.get(host, True))),
+                    ("problem_has_been_acknowledged",
+                     int((host, None) in self.acks))]))
+                for svc in sorted(self.host_services[host]):
+                    blocks.append(("servicestatus", [
+                        ("host_name", host),
+                        ("service_description", svc),
+                        ("notifications_enabled",
+                         int(self.svc_notifications.get((host, svc), True))),
+                        ("problem_has_been_acknowledged",
+                         int((host, svc) in self.acks))]))
+            for downtime_id in sorted(self.downtimes):
+                downtime = self.downtimes[downtime_id]
+                if "host_name" not in downtime:
+                    continue
+                if "service_description" in downtime:
+                    block_type = "servicedowntime"
+                else:
+                    block_type = "hostdowntime"
+                blocks.append((block_type, [
+                    (key, downtime[key]) for key in
+                    ("host_name", "service_description", "downtime_id",
+                     "entry_time", "start_time", "end_time", "triggered_by",
+                     "fixed", "duration", "author", "comment")
+                    if key in downtime]))
+        finally:
+            self.cond.release()
+
+        tmp_path = path + ".tmp"
+        fp = open(tmp_path, "w")
+        try:
+            for block_type, attrs in blocks:
+                fp.write("%s {\n" % block_type)
+                for key, value in attrs:
+                    fp.write("\t%s=%s\n" % (key, value))
+                fp.write("\t}\n\n")
+        finally:
+            fp.close()
+        os.rename(tmp_path, path)
+
+    def summary(self):
+        self.cond.acquire()
+        try:
+            return {"lines": self.lines,
+                    "torn": len(self.torn),
+                    "unknown": len(self.unknown),
+                    "commands": dict(self.counts),
+                    "downtimes": len(self.downtimes),
+                    "notifications_disabled":
+                        len([v for v in self.host_notifications.values()
+                             if not v]) +
+                        len([v for v in self.svc_notifications.values()
+                             if not v]),
+                    "acknowledged": len(self.acks)}
+        finally:
+            self.cond.release()
+
+
+class CommandReader(threading.Thread):
+    """
+    Reads the FIFO the way Nagios does, handing each complete line to
+    a SimulatedNagios, with optional faults.
+
+    Like Nagios, the FIFO is opened read-write and non-blocking, so
+    the reader never sees end of file when the writers come and go.
+    """
+
+    def __init__(self, path, sim, slow=0.0, restart_every=0.0,
+                 restart_for=0.5, stall_every=0.0, stall_for=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.sim = sim
+        self.slow = slow
+        self.read_size = slow and 512 or 65536
+        self.restart_every = restart_every
+        self.restart_for = restart_for
+        self.stall_every = stall_every
+        self.stall_for = stall_for
+        self.restarts = 0
+        self.stalls = 0
+        self.stopping = False
+        if os.path.exists(path):
+            os.unlink(path)
+        os.mkfifo(path)
+        self.fd = self._open()
+
+    def _open(self):
+        return os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+
+    def run(self):
+        buf = b""
+        next_restart = self.restart_every and time.time() + self.restart_every
+        next_stall = self.stall_every and time.time() + self.stall_every
+        while not self.stopping:
+            now = time.time()
+            if next_restart and now >= next_restart:
+                # Whatever is half read is lost, as it is when Nagios
+                # restarts
+                if buf:
+                    self.sim.process(buf.decode("utf-8", "replace"))
+                    buf = b""
+                os.close(self.fd)
+                time.sleep(self.restart_for)
+                self.fd = self._open()
+                self.restarts += 1
+                next_restart = time.time() + self.restart_every
+            if next_stall and now >= next_stall:
+                time.sleep(self.stall_for)
+                self.stalls += 1
+                next_stall = time.time() + self.stall_every
+
+            readable = select.select([self.fd], [], [], 0.05)[0]
+            if not readable:
+                continue
+            try:
+                data = os.read(self.fd, self.read_size)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            buf += data
+            lines = buf.split(b"\n")
+            buf = lines.pop()
+            for line in lines:
+                self.sim.process(line.decode("utf-8", "replace"))
+            if self.slow:
+                time.sleep(self.slow)
+
+        os.close(self.fd)
+
+
+class LivestatusListener(threading.Thread):
+    """
+    A stand-in for the MK Livestatus Unix socket. Each connection gets
+    its own thread, which hands every "COMMAND ..." request (ended by
+    a blank line) to a SimulatedNagios. Anything else, and a request
+    cut short by the connection closing, is counted in `partial`.
+    """
+
+    def __init__(self, path, sim):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.sim = sim
+        self.connections = 0
+        self.partial = 0
+        self.clients = []
+        self.lock = threading.Lock()
+        self.stopping = False
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+        self.drop()
+
+    def drop(self):
+        """
+        Close every client connection, the way Livestatus does when
+        Nagios restarts
+        """
+
+        self.lock.acquire()
+        try:
+            for client in self.clients:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.clients = []
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while not self.stopping:
+            if not select.select([self.sock], [], [], 0.05)[0]:
+                continue
+            client = self.sock.accept()[0]
+            self.lock.acquire()
+            try:
+                self.connections += 1
+                self.clients.append(client)
+            finally:
+                self.lock.release()
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+        self.sock.close()
+        os.unlink(self.path)
+
+    def handle(self, client):
+        buf = b""
+        while True:
+            try:
+                data = client.recv(65536)
+            except socket.error:
+                data = b""
+            if not data:
+                break
+            buf += data
+            requests = buf.split(b"\n\n")
+            buf = requests.pop()
+            for request in requests:
+                if request.startswith(b"COMMAND "):
+                    self.sim.process(request[8:].decode("utf-8", "replace"))
+                else:
+                    self.partial += 1
+        if buf:
+            self.partial += 1
+        client.close()
+
+
+class BrokenSocket(object):
+    """
+    Wraps a connected socket so only the first `limit` bytes are
+    sent and the next send fails, as when the server goes away
+    mid-send
+    """
+
+    def __init__(self, sock, limit):
+        self.sock = sock
+        self.limit = limit
+
+    def send(self, data):
+        if self.limit is None:
+            self.sock.close()
+            raise socket.error(errno.EPIPE, "Broken pipe")
+        sent = self.sock.send(data[:self.limit])
+        self.limit = None
+        return sent
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def close(self):
+        self.sock.close()
+
+
+def fault_options(parser):
+    parser.add_option("--slow", type="float", default=0.0,
+                      help="seconds to sleep between small reads")
+    parser.add_option("--restart-every", type="float", default=0.0,
+                      help="close and reopen the FIFO this often")
+    parser.add_option("--restart-for", type="float", default=0.5,
+                      help="seconds the FIFO stays closed on a restart")
+    parser.add_option("--stall-every", type="float", default=0.0,
+                      help="stop reading this often")
+    parser.add_option("--stall-for", type="float", default=1.0,
+                      help="seconds to stop reading for")
+
+
+def start_reader(path, sim, opts):
+    reader = CommandReader(path, sim, opts.slow, opts.restart_every,
+                           opts.restart_for, opts.stall_every,
+                           opts.stall_for)
+    reader.start()
+    return reader
+
+
+def serve(nagios, opts):
+    sim = SimulatedNagios(nagios.COMMANDS)
+    reader = start_reader(opts.fifo, sim, opts)
+    print("Reading %s, interrupt to stop" % opts.fifo)
+    try:
+        while True:
+            time.sleep(opts.status_interval)
+            if opts.status:
+                sim.write_status(opts.status)
+    except KeyboardInterrupt:
+        pass
+    reader.stop()
+    if opts.status:
+        sim.write_status(opts.status)
+    print(json.dumps(sim.summary(), indent=2, sort_keys=True))
+    for line in sim.torn:
+        print("torn: %r" % line)
+
+
+def sample_calls(nagios, hosts):
+    """
+    (method name, args) for every public method that sends commands,
+    with made up targets. The bulk methods get `hosts` targets.
+    """
+
+    samples = {"host_name": "sim-host",
+               "service_description": "svc-1",
+               "hostgroup_name": "sim-hosts",
+               "servicegroup_name": "sim-services",
+               "author": "sim",
+               "comment": "simulated",
+               "plugin_output": "OK - simulated"}
+    calls = []
+    methods = dict(nagios.DOWNTIME_METHODS + nagios.NOTIFICATION_METHODS)
+    for name in sorted(nagios.COMMANDS):
+        command = nagios.COMMANDS[name]
+        method = name.lower()
+        if method in methods and command.target == "service":
+            args = ("sim-host", ["svc-1", "svc-2"])
+        elif method in methods and command.target is not None:
+            args = (samples[command.params[0]],)
+        else:
+            args = tuple([samples.get(param, 1) for param in command.params])
+        if name.startswith("SCHEDULE_") and name.endswith("_DOWNTIME") and \
+                method in methods:
+            args += (5,)
+        calls.append((method, args))
+
+    targets = ["sim-host-%05d" % i for i in range(hosts)]
+    calls.append(("schedule_downtime_bulk", (targets, 5)))
+    calls.append(("disable_notifications_bulk",
+                  (dict([(host, ["svc-1"]) for host in targets]),)))
+    calls.append(("enable_notifications_bulk",
+                  (dict([(host, ["svc-1"]) for host in targets]),)))
+    calls.append(("send_command", ("ENABLE_NOTIFICATIONS",)))
+    return calls
+
+
+def written_lines(result):
+    """
+    Count the commands a method's result says were written.
+    """
+
+    if isinstance(result, dict):
+        return sum([written_lines(r) for r in result.values()])
+    if isinstance(result, list):
+        return sum([written_lines(r) for r in result])
+    return int(result.startswith("["))
+
+
+def new_module(nagios, path):
+    n = nagios.Nagios()
+    n.options.validate_targets = False
+    n.options.cmdfile = path
+    n._open_instance()
+    return n
+
+
+def load(nagios, opts):
+    workdir = tempfile.mkdtemp(prefix="func-nagios-sim-")
+    path = os.path.join(workdir, "nagios.cmd")
+    sim = SimulatedNagios(nagios.COMMANDS)
+    reader = start_reader(path, sim, opts)
+    results = []
+    expected = 0
+    failed = 0
+    try:
+        n = new_module(nagios, path)
+        for name, args in sample_calls(nagios, opts.hosts):
+            call_latencies = []
+            e2e_latencies = []
+            lines = 0
+            start = timer()
+            for i in range(opts.calls):
+                t = timer()
+                result = getattr(n, name)(*args)
+                call_latencies.append(timer() - t)
+                written = written_lines(result)
+                if not written:
+                    failed += 1
+                expected += written
+                lines += written
+                sim.wait_for(expected, 30.0)
+                e2e_latencies.append(timer() - t)
+            seconds = timer() - start
+            call_latencies.sort()
+            e2e_latencies.sort()
+            results.append({
+                "method": name,
+                "calls": opts.calls,
+                "lines": lines,
+                "lines_per_second": lines / seconds,
+                "call_p50_us": percentile(call_latencies, 0.5) * 1e6,
+                "call_p99_us": percentile(call_latencies, 0.99) * 1e6,
+                "e2e_p50_us": percentile(e2e_latencies, 0.5) * 1e6,
+                "e2e_p99_us": percentile(e2e_latencies, 0.99) * 1e6})
+
+        # Concurrent writers, each with its own module instance and
+        # command file descriptor, like func threads and the CGIs
+        counts = [0] * opts.threads
+
+        def hammer(i):
+            m = new_module(nagios, path)
+            targets = ["sim-thread%d-%05d" % (i, j) for j in range(opts.hosts)]
+            for call in range(opts.calls):
+                counts[i] += written_lines(
+                    m.schedule_downtime_bulk(targets, 5))
+
+        threads = [threading.Thread(target=hammer, args=(i,))
+                   for i in range(opts.threads)]
+        start = timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected += sum(counts)
+        sim.wait_for(expected, 30.0)
+        seconds = timer() - start
+        results.append({"method": "concurrent schedule_downtime_bulk",
+                        "calls": opts.calls * opts.threads,
+                        "lines": sum(counts),
+                        "lines_per_second": sum(counts) / seconds})
+    finally:
+        reader.stop()
+        shutil.rmtree(workdir)
+
+    summary = sim.summary()
+    summary["expected"] = expected
+    summary["failed_calls"] = failed
+    summary["restarts"] = reader.restarts
+    summary["stalls"] = reader.stalls
+
+    if opts.json:
+        print(json.dumps({"results": results, "simulator": summary},
+                         indent=2, sort_keys=True))
+    else:
+        print("%-46s %7s %8s %10s %9s %9s %9s %9s" %
+              ("method", "calls", "lines", "lines/s", "call p50", "call p99",
+               "e2e p50", "e2e p99"))
+        for r in results:
+            print("%-46s %7d %8d %10.0f %9.1f %9.1f %9.1f %9.1f" %
+                  (r["method"], r["calls"], r["lines"], r["lines_per_second"],
+                   r.get("call_p50_us", 0), r.get("call_p99_us", 0),
+                   r.get("e2e_p50_us", 0), r.get("e2e_p99_us", 0)))
+        print()
+        print("read %(lines)d of %(expected)d lines, %(torn)d torn, "
+              "%(failed_calls)d failed calls, %(restarts)d restarts, "
+              "%(stalls)d stalls" % summary)
+    for line in sim.torn:
+        print("torn: %r" % line)
+
+    faults = opts.restart_every or opts.stall_every
+    if sim.torn or (sim.lines != expected and not faults):
+        return 1
+    return 0
+
+
+def check_livestatus(nagios, opts):
+    workdir = tempfile.mkdtemp(prefix="func-nagios-sim-")
+    path = os.path.join(workdir, "live")
+    sim = SimulatedNagios(nagios.COMMANDS)
+    listener = LivestatusListener(path, sim)
+    listener.start()
+    checks = []
+
+    def check(name, ok, detail):
+        checks.append(ok)
+        print("%-4s %-10s %s" % (ok and "ok" or "FAIL", name, detail))
+
+    def sent(result, expected):
+        lines = written_lines(result)
+        return sim.wait_for(expected + lines, 10.0) and lines
+
+    try:
+        n = nagios.Nagios()
+        n.options.validate_targets = False
+        n.options.transport = "livestatus"
+        n.options.livestatus_socket = path
+        n._open_instance()
+        transport = n._transport
+        expected = 0
+
+        for i in range(opts.calls):
+            expected += sent(n.schedule_svc_downtime(
+                "sim-host", ["svc-1", "svc-2"], 5), expected)
+        check("pooling", transport.opens == 1 and sim.lines == expected,
+              "%d calls, %d connections, %d of %d lines" %
+              (opts.calls, listener.connections, sim.lines, expected))
+
+        targets = ["sim-host-%05d" % i for i in range(opts.hosts)]
+        expected += sent(n.schedule_downtime_bulk(targets, 5), expected)
+        check("pipelined", transport.opens == 1 and sim.lines == expected,
+              "%d commands in one call, %d connections" %
+              (opts.hosts, listener.connections))
+
+        listener.drop()
+        expected += sent(n.schedule_downtime_bulk(targets, 5), expected)
+        listener.stop()
+        listener = LivestatusListener(path, sim)
+        listener.start()
+        expected += sent(n.schedule_downtime_bulk(targets, 5), expected)
+        check("reconnect", transport.opens == 3 and sim.lines == expected,
+              "%d of %d lines after a drop and a restart" %
+              (sim.lines, expected))
+
+        # The first command goes out whole and the second is cut short
+        line = n._fmt_dt_str("SCHEDULE_HOST_DOWNTIME", targets[0], 5)
+        transport.close()
+        transport._put(BrokenSocket(transport._connect(),
+                                    len(line) + len("COMMAND \n") + 10))
+        expected += sent(n.schedule_downtime_bulk(targets, 5), expected)
+        time.sleep(0.1)
+        check("partial", sim.lines == expected and listener.partial == 1,
+              "%d of %d lines, %d cut short" %
+              (sim.lines, expected, listener.partial))
+    finally:
+        listener.stop()
+        shutil.rmtree(workdir)
+
+    if sim.torn or not all(checks):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage="%prog serve --fifo PATH [options]\n"
+              "       %prog load [options]\n"
+              "       %prog livestatus [options]")
+    parser.add_option("--fifo", help="FIFO to create and read (serve)")
+    parser.add_option("--status", help="status.dat to write (serve)")
+    parser.add_option("--status-interval", type="float", default=10.0,
+                      help="seconds between status.dat writes (serve)")
+    parser.add_option("--calls", type="int", default=20,
+                      help="calls per method (load, livestatus)")
+    parser.add_option("--hosts", type="int", default=100,
+                      help="targets per bulk call (load, livestatus)")
+    parser.add_option("--threads", type="int", default=8,
+                      help="concurrent writers (load)")
+    parser.add_option("--json", action="store_true", default=False,
+                      help="print the results as JSON (load)")
+    fault_options(parser)
+    opts, args = parser.parse_args()
+    if args not in (["serve"], ["load"], ["livestatus"]) or \
+            (args == ["serve"] and not opts.fifo):
+        parser.error("give serve --fifo PATH, load or livestatus")
+
+    install_stubs()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "src"))
+    import nagios
+
+    if args == ["serve"]:
+        serve(nagios, opts)
+    elif args == ["livestatus"]:
+        sys.exit(check_livestatus(nagios, opts))
+    else:
+        sys.exit(load(nagios, opts))
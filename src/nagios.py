@@ -8,155 +8,4057 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from certmaster.config import BaseConfig, Option
+from certmaster.config import BaseConfig, BoolOption, FloatOption, \
+    IntOption, Option
+import collections
+import copy
+import ctypes
+import ctypes.util
+import errno
+import bisect
+import fnmatch
 import func_module
+import functools
+import hashlib
+import heapq
+import json
+import os
+import re
+import select
+import socket
+import threading
 import time
+import types
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+# Writes of up to PIPE_BUF bytes to a FIFO are atomic, so a chunk no
+# larger than this can't be interleaved with lines from the other
+# command file writers (the CGIs, NRDP, etc). 512 is the POSIX minimum.
+try:
+    PIPE_BUF = select.PIPE_BUF
+except AttributeError:
+    PIPE_BUF = 512
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+WRITE_FAIL = "Fail: could not write to the command file"
+OBJECTS_FAIL = "Fail: could not read the object cache"
+STATUS_FAIL = "Fail: could not read the status file"
+SKIPPED = "Skipped: already in the requested state"
+SPOOLED = "Spooled: the command file is unavailable, will retry"
+
+# Lines of a check results file submitted at a time
+CHECK_RESULT_BATCH = 10000
+
+# Compiled service patterns kept by service_matcher
+SERVICE_MATCHER_CACHE = 1000
+
+# Where func reads the module's configuration. Extra Nagios instances
+# are configured in [instance:NAME] sections of the same file.
+CONFIG_FILE = "/etc/func/modules/Nagios.conf"
+INSTANCE_SECTION = "instance:"
+# The [main] options an [instance:NAME] section can set
+INSTANCE_OPTIONS = ["cmdfile", "cmdfile_timeout", "transport",
+                    "livestatus_socket", "object_cache_file", "status_file",
+                    "validate_targets", "idempotent"]
+
+
+def _encode(s):
+    """
+    Return s as bytes suitable for os.write
+    """
+
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+
+def _split_members(members):
+    """
+    Split a comma separated member list from a Nagios object
+    """
+
+    return [m.strip() for m in members.split(",") if m.strip()]
+
+
+def escape_output(output):
+    """
+    Escape plugin output for a passive check result, which must fit
+    on one command line. Nagios turns "\\n" back into a newline and
+    "\\\\" back into a backslash.
+    """
+
+    return output.replace("\\", "\\\\").replace("\r", "").replace(
+        "\n", "\\n")
+
+
+_service_matchers = {}
+
+
+def service_matcher(selector):
+    """
+    Match function for a service selector, or None if the selector is
+    a plain service name. Selectors starting with "re:" are regular
+    expressions, searched for in each service description. Selectors
+    starting with "glob:" are shell-style globs that must match the
+    whole description. Anything else is a plain name, even if it
+    contains *, ? or [. Matchers are compiled once per selector.
+
+    Raises re.error for a bad regular expression.
+    """
+
+    if selector.startswith("re:"):
+        pattern = selector[3:]
+    elif selector.startswith("glob:"):
+        pattern = fnmatch.translate(selector[5:])
+    else:
+        return None
+
+    matcher = _service_matchers.get(selector)
+    if matcher is None:
+        matcher = re.compile(pattern)
+        if selector.startswith("re:"):
+            matcher = matcher.search
+        else:
+            matcher = matcher.match
+        if len(_service_matchers) >= SERVICE_MATCHER_CACHE:
+            _service_matchers.clear()
+        _service_matchers[selector] = matcher
+    return matcher
+
+
+def parse_nagios_blocks(fp, keys=None):
+    """
+    Parse a Nagios objects.cache or status.dat file one block at a
+    time, without reading the whole file into memory.
+
+    Yields a (block_type, {attribute: value}) tuple for each block.
+    objects.cache blocks look like "define host {" followed by tab
+    separated attributes, status.dat blocks look like "hoststatus {"
+    followed by attribute=value lines. If keys is given only those
+    attributes are kept.
+    """
+
+    block_type = None
+    for line in fp:
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+
+        if block_type is None:
+            if line[-1] == "{":
+                block_type = line[:-1].strip()
+                if block_type.startswith("define "):
+                    block_type = block_type[7:].strip()
+                    sep = None
+                else:
+                    sep = "="
+                attrs = {}
+        elif line == "}":
+            yield block_type, attrs
+            block_type = None
+        else:
+            parts = line.split(sep, 1)
+            if keys is not None and parts[0] not in keys:
+                continue
+            if len(parts) == 2:
+                attrs[parts[0]] = parts[1].strip()
+            else:
+                attrs[parts[0]] = ""
+
+
+def coalesce_commands(batch):
+    """
+    Drop duplicate and superseded commands from a batch of
+    (ticket, cmd) tuples.
+
+    Only ENABLE_ and DISABLE_ commands are coalesced: two of them are
+    duplicates when they are the same apart from the entry time, and
+    an ENABLE_ command and the DISABLE_ command for the same target
+    supersede each other. In both cases only the last command is kept,
+    since that is the state Nagios would end up in. Every other
+    command, such as a check result or an acknowledgement, is an event
+    of its own and is always kept.
+
+    Returns a (kept, dropped) tuple of lists of (ticket, cmd) tuples,
+    with kept in the original order.
+    """
+
+    last = {}
+    keep = set()
+    for i, (ticket, cmd) in enumerate(batch):
+        body = cmd.split("] ", 1)[-1]
+        name, sep, args = body.partition(";")
+        for prefix in ("ENABLE_", "DISABLE_"):
+            if name.startswith(prefix):
+                last[(name[len(prefix):], args)] = i
+                break
+        else:
+            keep.add(i)
+
+    keep.update(last.values())
+    kept = []
+    dropped = []
+    for i, item in enumerate(batch):
+        if i in keep:
+            kept.append(item)
+        else:
+            dropped.append(item)
+
+    return kept, dropped
+
+
+class CommandQueue(object):
+    """
+    Commands waiting to be written to the command file by a background
+    thread.
+
+    Callers get a ticket back as soon as their commands are queued.
+    The writer thread flushes the queue `interval` seconds after the
+    first command arrives, or as soon as `size` commands are waiting,
+    coalescing duplicate and contradictory commands first. The
+    progress of each ticket can be checked with `status`.
+
+    Queued commands only live in memory; they are lost if the minion
+    exits before they are flushed.
+    """
+
+    # Number of finished tickets to remember
+    history = 10000
+
+    def __init__(self, deliver, interval, size):
+        self.deliver = deliver
+        self.interval = interval
+        self.size = size
+        self.cond = threading.Condition()
+        self.pending = []
+        self.tickets = {}
+        self.finished = collections.deque()
+        self.next_ticket = 1
+        self.thread = None
+
+    def put(self, cmds):
+        """
+        Queue a list of formatted commands. Returns their ticket.
+        """
+
+        self.cond.acquire()
+        try:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.tickets[ticket] = {"queued": len(cmds), "written": 0,
+                                    "failed": 0, "spooled": 0,
+                                    "coalesced": 0}
+            self.pending.extend([(ticket, cmd) for cmd in cmds])
+            if not cmds:
+                self._finish(ticket)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+        return ticket
+
+    def status(self, ticket):
+        """
+        Return a copy of the counters for a ticket, or None if the
+        ticket is unknown or was forgotten
+        """
+
+        self.cond.acquire()
+        try:
+            counts = self.tickets.get(ticket)
+            if counts is None:
+                return None
+            return dict(counts)
+        finally:
+            self.cond.release()
+
+    def _finish(self, ticket):
+        """
+        Remember a ticket whose commands have all been handled,
+        forgetting the oldest finished tickets. Called with the lock
+        held.
+        """
+
+        self.finished.append(ticket)
+        while len(self.finished) > self.history:
+            del self.tickets[self.finished.popleft()]
+
+    def _count(self, items, key):
+        """
+        Add each (ticket, cmd) in items to the ticket's `key` counter.
+        Called with the lock held.
+        """
+
+        for ticket, cmd in items:
+            counts = self.tickets[ticket]
+            counts[key] += 1
+            counts["queued"] -= 1
+            if counts["queued"] == 0:
+                self._finish(ticket)
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.pending:
+                    self.cond.wait()
+                deadline = time.time() + self.interval
+                while len(self.pending) < self.size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.pending
+                self.pending = []
+            finally:
+                self.cond.release()
+
+            kept, dropped = coalesce_commands(batch)
+            chunks = self.deliver([cmd for (ticket, cmd) in kept])
+
+            self.cond.acquire()
+            try:
+                self._count(dropped, "coalesced")
+                i = 0
+                for status, chunk in chunks:
+                    self._count(kept[i:i + len(chunk)], status)
+                    i += len(chunk)
+            finally:
+                self.cond.release()
+
+
+class CommandSpool(object):
+    """
+    An on-disk journal of commands that couldn't be written to the
+    command file, replayed in order by a background thread once it
+    can be written again.
+
+    Each line of the journal is "<time spooled> <command>". Appends
+    are fsync()ed once per batch. Before a command is replayed its
+    entry time is set to the current time, and downtime whose window
+    has already ended is dropped instead.
+
+    write_commands - Callable writing a list of commands, like
+      `Nagios._write_commands`
+    now - Callable returning the current time, like `Nagios._now`
+    interval - Seconds between replay attempts
+    """
+
+    def __init__(self, path, write_commands, now, interval):
+        self.path = path
+        self.write_commands = write_commands
+        self.now = now
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        entries = self._read()
+        self.depth = len(entries)
+        self.oldest = entries and entries[0][0] or None
+        if entries:
+            self._start()
+
+    def _read(self):
+        """
+        Read the journal as a list of (time spooled, command) tuples
+        """
+
+        entries = []
+        try:
+            fp = open(self.path)
+        except IOError:
+            return entries
+        try:
+            for line in fp:
+                spooled, sep, cmd = line.partition(" ")
+                if spooled.isdigit() and cmd.endswith("\n"):
+                    entries.append((int(spooled), cmd))
+        finally:
+            fp.close()
+        return entries
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def append(self, cmds):
+        """
+        Add commands to the end of the journal. Raises IOError or
+        OSError if they couldn't be saved.
+        """
+
+        spooled = self.now()
+        self.lock.acquire()
+        try:
+            fp = open(self.path, "a")
+            try:
+                fp.write("".join(["%d %s" % (spooled, cmd) for cmd in cmds]))
+                fp.flush()
+                os.fsync(fp.fileno())
+            finally:
+                fp.close()
+            self.depth += len(cmds)
+            if self.oldest is None:
+                self.oldest = spooled
+            self._start()
+        finally:
+            self.lock.release()
+
+    def _expired(self, body, now):
+        """
+        True if a command schedules downtime that has already ended
+        """
+
+        fields = body.rstrip("\n").split(";")
+        command = COMMANDS.get(fields[0])
+        if command is None or "end_time" not in command.params:
+            return False
+        try:
+            return int(fields[command.params.index("end_time") + 1]) <= now
+        except (IndexError, ValueError):
+            return False
+
+    def _rewrite(self, entries):
+        """
+        Replace the journal with the given entries
+        """
+
+        tmp_path = self.path + ".tmp"
+        fp = open(tmp_path, "w")
+        try:
+            fp.write("".join(["%d %s" % entry for entry in entries]))
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.path)
+        self.depth = len(entries)
+        self.oldest = entries and entries[0][0] or None
+
+    def replay(self):
+        """
+        Write as much of the journal as possible, in order. Returns
+        True once the journal is empty.
+        """
+
+        self.lock.acquire()
+        try:
+            now = self.now()
+            entries = []
+            for spooled, cmd in self._read():
+                body = cmd.split("] ", 1)[-1]
+                if not self._expired(body, now):
+                    entries.append((spooled, "[%d] %s" % (now, body)))
+
+            written = 0
+            for ok, chunk in self.write_commands([e[1] for e in entries]):
+                if not ok:
+                    break
+                written += len(chunk)
+
+            self._rewrite(entries[written:])
+            return not self.depth
+        finally:
+            self.lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.replay():
+                    break
+            except (IOError, OSError):
+                pass
+
+        self.lock.acquire()
+        try:
+            self.thread = None
+            # Commands may have been spooled while we were finishing
+            if self.depth:
+                self._start()
+        finally:
+            self.lock.release()
+
+
+def command_class(cmd):
+    """
+    The pacing class of a formatted command: "notifications" for the
+    notification toggles, "downtime" for scheduling and deleting
+    downtime, and "other" for everything else.
+    """
+
+    name = cmd.split("] ", 1)[-1].split(";", 1)[0].rstrip()
+    if name.endswith("_NOTIFICATIONS") and \
+            (name.startswith("ENABLE_") or name.startswith("DISABLE_")):
+        return "notifications"
+    if name.endswith("_DOWNTIME"):
+        return "downtime"
+    return "other"
+
+
+class CommandPacer(object):
+    """
+    Token bucket limiting how many command lines per second are
+    written, so a huge batch can't fill Nagios' external command
+    buffer ahead of more urgent commands.
+
+    Writers call `acquire` with the number of lines they are about to
+    write and their class. Tokens accrue at `rate` per second up to
+    `burst`. Waiting writers are let through in priority order (the
+    lowest number in `priorities` first), and in the order they
+    arrived within a class. A write larger than the burst goes through
+    once a full burst is available and leaves the bucket in debt, so
+    the average rate still holds.
+    """
+
+    def __init__(self, rate, burst, priorities):
+        self.rate = rate
+        self.burst = burst
+        self.priorities = priorities
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.cond = threading.Condition()
+        # Heap of (priority, arrival, lines, since, class)
+        self.waiting = []
+        self.arrivals = 0
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self, lines, klass):
+        """
+        Wait until lines of the given class may be written.
+        """
+
+        self.cond.acquire()
+        try:
+            start = time.time()
+            entry = (self.priorities[klass], self.arrivals, lines, start,
+                     klass)
+            self.arrivals += 1
+            heapq.heappush(self.waiting, entry)
+            need = min(lines, self.burst)
+            while True:
+                now = time.time()
+                self._refill(now)
+                if self.waiting[0] is not entry:
+                    # Woken when the writer ahead of us goes through
+                    self.cond.wait()
+                elif self.tokens < need:
+                    self.cond.wait((need - self.tokens) / self.rate)
+                else:
+                    break
+            heapq.heappop(self.waiting)
+            self.tokens -= lines
+            self.waited += now - start
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def status(self):
+        self.cond.acquire()
+        try:
+            now = time.time()
+            self._refill(now)
+            waiting = dict([(klass, 0) for klass in self.priorities])
+            oldest = now
+            for priority, arrival, lines, since, klass in self.waiting:
+                waiting[klass] += lines
+                oldest = min(oldest, since)
+            backlog = sum(waiting.values())
+            return {"enabled": True,
+                    "rate": self.rate,
+                    "burst": self.burst,
+                    "tokens": self.tokens,
+                    "backlog": backlog,
+                    "waiting": waiting,
+                    "wait": max(0.0, (backlog - self.tokens) / self.rate),
+                    "age": now - oldest,
+                    "waited": self.waited}
+        finally:
+            self.cond.release()
+
+
+class ResultStore(object):
+    """
+    The full results of recent calls made with `verbose` off, kept in
+    memory so they can be fetched a page at a time.
+    """
+
+    # Number of result sets to remember
+    history = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.order = collections.deque()
+        self.next_id = 1
+
+    def add(self, results):
+        """
+        Keep a list of results, returning the id to fetch it by.
+        """
+
+        self.lock.acquire()
+        try:
+            result_id = self.next_id
+            self.next_id += 1
+            self.results[result_id] = results
+            self.order.append(result_id)
+            while len(self.order) > self.history:
+                del self.results[self.order.popleft()]
+            return result_id
+        finally:
+            self.lock.release()
+
+    def get(self, result_id):
+        self.lock.acquire()
+        try:
+            return self.results.get(result_id)
+        finally:
+            self.lock.release()
+
+
+def summarize_results(results_by_target):
+    """
+    Condense a dict of target -> list of results into counts of each
+    kind of result, the targets with failures, and a digest of the
+    full text.
+    """
+
+    summary = {"commands": 0, "written": 0, "queued": 0, "spooled": 0,
+               "skipped": 0, "failed": 0}
+    failed_targets = []
+    digest = hashlib.sha1()
+    for target in sorted(results_by_target):
+        failed = False
+        for result in results_by_target[target]:
+            digest.update(_encode(result))
+            if result.startswith("Fail:"):
+                summary["failed"] += 1
+                failed = True
+                # Checks that fail before any command is formatted
+                # don't count as commands
+                if result.startswith(WRITE_FAIL):
+                    summary["commands"] += 1
+                continue
+            summary["commands"] += 1
+            if result.startswith("Queued as ticket"):
+                summary["queued"] += 1
+            elif result.startswith("Spooled:"):
+                summary["spooled"] += 1
+            elif result.startswith("Skipped:"):
+                summary["skipped"] += 1
+            else:
+                summary["written"] += 1
+        if failed:
+            failed_targets.append(target)
+
+    summary["failed_targets"] = failed_targets
+    summary["digest"] = digest.hexdigest()[:16]
+    return summary
+
+
+class Stats(object):
+    """
+    Call counts, latency histograms and command file I/O counters for
+    the `stats` method.
+
+    Each latency histogram counts calls by the first bucket (an upper
+    bound in milliseconds) their duration fits in, with a final
+    bucket for anything slower.
+    """
+
+    buckets = [1, 5, 10, 50, 100, 500, 1000, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero every counter
+        """
+
+        self.lock.acquire()
+        try:
+            # method name -> [calls, errors, seconds, [bucket counts]]
+            self.methods = {}
+            self.io = {"chunks_written": 0, "lines_written": 0,
+                       "bytes_written": 0, "write_failures": 0,
+                       "blocked_seconds": 0.0}
+        finally:
+            self.lock.release()
+
+    def record_call(self, name, seconds, error):
+        bucket = bisect.bisect_left(self.buckets, seconds * 1000)
+        self.lock.acquire()
+        try:
+            method = self.methods.get(name)
+            if method is None:
+                method = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+                self.methods[name] = method
+            method[0] += 1
+            if error:
+                method[1] += 1
+            method[2] += seconds
+            method[3][bucket] += 1
+        finally:
+            self.lock.release()
+
+    def record_write(self, lines, size, seconds, written):
+        self.lock.acquire()
+        try:
+            if written:
+                self.io["chunks_written"] += 1
+                self.io["lines_written"] += lines
+                self.io["bytes_written"] += size
+            else:
+                self.io["write_failures"] += 1
+            self.io["blocked_seconds"] += seconds
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """
+        The counters as a dict that XML-RPC can marshal
+        """
+
+        labels = [str(bound) for bound in self.buckets] + ["inf"]
+        self.lock.acquire()
+        try:
+            methods = {}
+            for name, (calls, errors, seconds, counts) in \
+                    self.methods.items():
+                methods[name] = {"calls": calls, "errors": errors,
+                                 "seconds": seconds,
+                                 "latency_ms": dict(zip(labels, counts))}
+            io = {}
+            for name, value in self.io.items():
+                # XML-RPC integers are 32 bit
+                if value > 0x7fffffff:
+                    value = float(value)
+                io[name] = value
+            return {"methods": methods, "io": io}
+        finally:
+            self.lock.release()
+
+
+def _is_failure(result):
+    """
+    Whether a method's result reports a failure: a "Fail:" message, a
+    list or dict holding one, or a summary with failed commands
+    """
+
+    if hasattr(result, "startswith"):
+        return result.startswith("Fail:")
+    if isinstance(result, (list, tuple)):
+        for item in result:
+            if _is_failure(item):
+                return True
+    elif isinstance(result, dict):
+        if "failed_targets" in result:
+            return result.get("failed", 0) > 0
+        for item in result.values():
+            if _is_failure(item):
+                return True
+    return False
+
+
+def _timed_method(stats, name, method):
+    """
+    Wrap a bound public method so each call is recorded in stats.
+    Calls that raise or return a failure count as errors.
+
+    The wrapper is compiled with the same arguments and defaults as
+    the method, so func's get_method_args still sees the real
+    signature.
+    """
+
+    def call(*args, **kwargs):
+        start = time.time()
+        error = True
+        try:
+            result = method(*args, **kwargs)
+            error = _is_failure(result)
+            return result
+        finally:
+            stats.record_call(name, time.time() - start, error)
+
+    func = method.__func__
+    code = func.__code__
+    names = list(code.co_varnames[:code.co_argcount])
+    defaults = func.__defaults__ or ()
+    params = list(names)
+    for i in range(len(defaults)):
+        params[len(names) - len(defaults) + i] += "=_defaults[%d]" % i
+    # Skip self, call is given the bound method's arguments
+    arguments = names[1:]
+    extra = code.co_argcount
+    if code.co_flags & 0x04:
+        params.append("*" + code.co_varnames[extra])
+        arguments.append("*" + code.co_varnames[extra])
+        extra += 1
+    if code.co_flags & 0x08:
+        params.append("**" + code.co_varnames[extra])
+        arguments.append("**" + code.co_varnames[extra])
+
+    namespace = {"_defaults": defaults, "_call": call}
+    exec("def timed(%s):\n    return _call(%s)\n" %
+         (", ".join(params), ", ".join(arguments)), namespace)
+    return functools.update_wrapper(namespace["timed"], func)
+
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def next_window(definition, after):
+    """
+    Start time of the first window of a recurring maintenance
+    definition that begins after `after`, in local time. The
+    definition's "days" list names the weekdays it runs on, or is
+    empty to run every day.
+    """
+
+    hour, minute = [int(part) for part in definition["at"].split(":")]
+    days = [WEEKDAYS.index(day) for day in definition["days"]]
+    day = time.localtime(after)
+    for offset in range(8):
+        start = int(time.mktime((day.tm_year, day.tm_mon,
+                                 day.tm_mday + offset, hour, minute, 0,
+                                 0, 0, -1)))
+        if start > after and \
+                (not days or time.localtime(start).tm_wday in days):
+            return start
+    return None
+
+
+class MaintenanceScheduler(object):
+    """
+    Recurring maintenance windows, kept in a JSON file so they survive
+    minion restarts.
+
+    Upcoming windows sit in a heap ordered by when their downtime
+    should be submitted, `lead` seconds before they start. A
+    background thread sleeps until the first one is due and then hands
+    every due window to `submit` in one call, which schedules the
+    downtime. The last window submitted for each definition is saved
+    so it isn't submitted twice. A window whose downtime fails is
+    tried again every `retry_interval` seconds until it ends, with the
+    failure in the definition's "last_result".
+
+    submit - Callable taking a list of (definition, start) tuples and
+      returning a list of results, one per tuple. A result starting
+      with "Fail:" means the window's downtime wasn't scheduled.
+    """
+
+    retry_interval = 30
+
+    def __init__(self, path, lead, submit):
+        self.path = path
+        self.lead = lead
+        self.submit = submit
+        self.cond = threading.Condition()
+        self.heap = []
+        self.thread = None
+        self.definitions = {}
+        self.next_id = 1
+        self._read()
+        now = time.time()
+        for definition in self.definitions.values():
+            self._push(definition, now)
+        if self.heap:
+            self._start()
+
+    def _read(self):
+        try:
+            fp = open(self.path)
+        except IOError:
+            return
+        try:
+            try:
+                saved = json.load(fp)
+                self.definitions = saved["definitions"]
+                self.next_id = saved["next_id"]
+            except (ValueError, KeyError, TypeError):
+                # An unreadable file is left alone until the next
+                # add_maintenance overwrites it
+                self.definitions = {}
+        finally:
+            fp.close()
+
+    def _save(self):
+        """
+        Write the definitions out. Called with the lock held.
+        """
+
+        tmp_path = self.path + ".tmp"
+        fp = open(tmp_path, "w")
+        try:
+            json.dump({"definitions": self.definitions,
+                       "next_id": self.next_id}, fp, indent=1)
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.path)
+
+    def _push(self, definition, now):
+        """
+        Queue a definition's next window. Called with the lock held.
+        """
+
+        after = max(now, definition.get("last_submitted", 0))
+        start = next_window(definition, after)
+        if start is not None:
+            definition["next_window"] = start
+            heapq.heappush(self.heap, (start - self.lead, start,
+                                       definition["id"]))
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, definition):
+        """
+        Save a new definition and queue its first window. Returns the
+        definition, with its "id" and "next_window" filled in.
+        """
+
+        self.cond.acquire()
+        try:
+            definition["id"] = str(self.next_id)
+            self.definitions[definition["id"]] = definition
+            self.next_id += 1
+            try:
+                self._save()
+            except (IOError, OSError):
+                del self.definitions[definition["id"]]
+                self.next_id -= 1
+                raise
+            self._push(definition, time.time())
+            self._start()
+            self.cond.notify()
+            return dict(definition)
+        finally:
+            self.cond.release()
+
+    def remove(self, definition_id):
+        """
+        Forget a definition. Returns False if there was no such
+        definition. Its windows are dropped from the heap as they come
+        up.
+        """
+
+        self.cond.acquire()
+        try:
+            definition = self.definitions.pop(definition_id, None)
+            if definition is None:
+                return False
+            self._save()
+            return True
+        finally:
+            self.cond.release()
+
+    def list(self):
+        self.cond.acquire()
+        try:
+            return [dict(definition) for definition in
+                    sorted(self.definitions.values(),
+                           key=lambda d: int(d["id"]))]
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while True:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    if self.heap:
+                        self.cond.wait(self.heap[0][0] - now)
+                    else:
+                        self.cond.wait()
+
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    submit_at, start, definition_id = heapq.heappop(self.heap)
+                    definition = self.definitions.get(definition_id)
+                    # Skip removed definitions and stale heap entries
+                    if definition is not None and \
+                            definition.get("next_window") == start:
+                        due.append((definition, start))
+            finally:
+                self.cond.release()
+
+            if not due:
+                continue
+            try:
+                results = self.submit(due)
+            except Exception as e:
+                results = ["Fail: %s" % e] * len(due)
+
+            self.cond.acquire()
+            try:
+                now = time.time()
+                for (definition, start), result in zip(due, results):
+                    definition["last_result"] = result
+                    if definition["id"] not in self.definitions:
+                        continue
+                    retry_at = now + self.retry_interval
+                    if result.startswith("Fail:") and \
+                            retry_at < start + definition["minutes"] * 60:
+                        heapq.heappush(self.heap, (retry_at, start,
+                                                   definition["id"]))
+                        continue
+                    definition["last_submitted"] = start
+                    self._push(definition, now)
+                try:
+                    self._save()
+                except (IOError, OSError):
+                    pass
+            finally:
+                self.cond.release()
+
+
+class Inotify(object):
+    """
+    Minimal inotify(7) binding through ctypes, watching one directory
+    for files being written, created or renamed into it. Raises
+    OSError where inotify isn't available.
+    """
+
+    IN_MODIFY = 0x002
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self, path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            init = libc.inotify_init
+            add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE
+        if add_watch(self.fd, _encode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for something in the directory to
+        change, and discard the events.
+        """
+
+        if select.select([self.fd], [], [], timeout)[0]:
+            os.read(self.fd, 65536)
+
+
+class LogWatcher(object):
+    """
+    Follows nagios.log from its current end, noting when each
+    EXTERNAL COMMAND line appears, so callers can wait for Nagios to
+    log the commands they sent. Nagios only logs them with
+    log_external_commands=1.
+
+    A background thread reads new lines as inotify reports changes to
+    the log's directory, or every `poll` seconds where inotify isn't
+    available. A rotated log is followed to the new file.
+    """
+
+    marker = "EXTERNAL COMMAND: "
+    # Number of logged commands to remember
+    history = 100000
+    poll = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        # command -> list of times it was seen, oldest first
+        self.seen = {}
+        self.order = collections.deque()
+        self.fp = open(path)
+        self.fp.seek(0, os.SEEK_END)
+        self.inode = os.fstat(self.fp.fileno()).st_ino
+        self.partial = ""
+        try:
+            self.inotify = Inotify(os.path.dirname(os.path.abspath(path)))
+        except OSError:
+            self.inotify = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        # Seeking clears the end of file indicator, which Python 2's
+        # stdio based files would otherwise keep set
+        self.fp.seek(0, os.SEEK_CUR)
+        data = self.fp.read()
+        if not data:
+            return
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        now = time.time()
+        self.cond.acquire()
+        try:
+            for line in lines:
+                if self.marker not in line:
+                    continue
+                command = line.split(self.marker, 1)[1]
+                self.seen.setdefault(command, []).append(now)
+                self.order.append(command)
+                if len(self.order) > self.history:
+                    old = self.order.popleft()
+                    times = self.seen.get(old)
+                    if times:
+                        times.pop(0)
+                        if not times:
+                            del self.seen[old]
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        while True:
+            if self.inotify is not None:
+                self.inotify.wait(1.0)
+            else:
+                time.sleep(self.poll)
+            try:
+                self._read()
+                if os.stat(self.path).st_ino != self.inode:
+                    # Rotated: finish the old file, then start on the
+                    # new one from the beginning
+                    self._read()
+                    self.fp.close()
+                    self.fp = open(self.path)
+                    self.inode = os.fstat(self.fp.fileno()).st_ino
+                    self.partial = ""
+                    self._read()
+            except (IOError, OSError):
+                pass
+
+    def wait(self, commands, since, timeout):
+        """
+        Wait until every command in the list has been logged at or
+        after `since`, or timeout seconds pass. commands are formatted
+        command lines. Each log line is only matched once, so sending
+        the same command twice needs it logged twice.
+
+        Returns a list with the seconds from `since` until each
+        command was logged, or -1 for those that weren't.
+        """
+
+        keys = [cmd.split("] ", 1)[-1].rstrip("\n") for cmd in commands]
+        latencies = [-1] * len(keys)
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                for i, key in enumerate(keys):
+                    if latencies[i] != -1:
+                        continue
+                    times = self.seen.get(key, [])
+                    while times and times[0] < since:
+                        times.pop(0)
+                    if times:
+                        latencies[i] = times.pop(0) - since
+                remaining = deadline - time.time()
+                if -1 not in latencies or remaining <= 0:
+                    return latencies
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+
+class CachedFile(object):
+    """
+    Base class for in-memory indexes built from a Nagios data file.
+
+    The index is built the first time `refresh` is called and rebuilt
+    only when the file's mtime or size changes, so repeated lookups
+    cost a stat() and a dictionary lookup. Subclasses implement
+    `_load`, which builds the index from an open file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Rebuild the index if the file changed. Returns False if the
+        file couldn't be read.
+        """
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+
+        stamp = (st.st_mtime, st.st_size)
+        self.lock.acquire()
+        try:
+            if stamp != self.stamp:
+                try:
+                    fp = open(self.path)
+                    try:
+                        self._load(fp)
+                    finally:
+                        fp.close()
+                except IOError:
+                    return False
+                self.stamp = stamp
+        finally:
+            self.lock.release()
+
+        return True
+
+    def _load(self, fp):
+        raise NotImplementedError
+
+
+class ObjectCache(CachedFile):
+    """
+    Index of the hosts, services, hostgroups and servicegroups in
+    Nagios' objects.cache.
+
+    host_services - host name -> set of service descriptions
+    hostgroups - hostgroup name -> set of host names
+    servicegroups - servicegroup name -> set of (host, service) tuples
+    host_children - host name -> set of the hosts that list it in
+      their parents
+    """
+
+    def __init__(self, path):
+        CachedFile.__init__(self, path)
+        self.host_services = {}
+        self.hostgroups = {}
+        self.servicegroups = {}
+        self.host_children = {}
+
+    def _load(self, fp):
+        host_services = {}
+        hostgroups = {}
+        servicegroups = {}
+        host_children = {}
+
+        for block_type, attrs in parse_nagios_blocks(fp):
+            if block_type == "host":
+                host = attrs.get("host_name")
+                host_services.setdefault(host, set())
+                for parent in _split_members(attrs.get("parents", "")):
+                    host_children.setdefault(parent, set()).add(host)
+            elif block_type == "service":
+                host_services.setdefault(attrs.get("host_name"), set()).add(
+                    attrs.get("service_description"))
+            elif block_type == "hostgroup":
+                members = _split_members(attrs.get("members", ""))
+                hostgroups[attrs.get("hostgroup_name")] = set(members)
+            elif block_type == "servicegroup":
+                # Servicegroup members are host,service pairs
+                members = _split_members(attrs.get("members", ""))
+                servicegroups[attrs.get("servicegroup_name")] = set(
+                    zip(members[0::2], members[1::2]))
+
+        self.host_services = host_services
+        self.hostgroups = hostgroups
+        self.servicegroups = servicegroups
+        self.host_children = host_children
+
+    def descendants(self, host):
+        """
+        Every host below the given one in the parent/child topology,
+        breadth first, so each host comes after its parents. Hosts
+        reachable by more than one path, or through a loop, are only
+        listed once.
+        """
+
+        seen = set([host])
+        order = []
+        pending = collections.deque([host])
+        while pending:
+            for child in self.host_children.get(pending.popleft(), ()):
+                if child not in seen:
+                    seen.add(child)
+                    order.append(child)
+                    pending.append(child)
+        return order
+
+
+class StatusCache(CachedFile):
+    """
+    Index of the current state Nagios writes to status.dat.
+
+    hosts - host name -> (notifications_enabled, downtime_depth,
+      acknowledged)
+    services - (host, service) -> (notifications_enabled,
+      downtime_depth, acknowledged)
+    host_services - host name -> list of service descriptions
+    downtimes - list of downtime dicts, in status.dat order
+    host_downtimes - host name -> list of that host's downtime dicts,
+      for both host and service downtime
+    service_downtimes - (host, service) -> list of downtime dicts
+    author_downtimes - author -> list of downtime dicts
+    """
+
+    keys = set(["host_name", "service_description",
+                "notifications_enabled", "scheduled_downtime_depth",
+                "problem_has_been_acknowledged", "downtime_id",
+                "entry_time", "start_time", "end_time", "fixed",
+                "triggered_by", "duration", "author", "comment"])
+
+    # Integer attributes of a downtime
+    downtime_ints = ["downtime_id", "entry_time", "start_time", "end_time",
+                     "fixed", "triggered_by", "duration"]
+
+    def __init__(self, path):
+        CachedFile.__init__(self, path)
+        self.hosts = {}
+        self.services = {}
+        self.host_services = {}
+        self.downtimes = []
+        self.host_downtimes = {}
+        self.service_downtimes = {}
+        self.author_downtimes = {}
+
+    def _state(self, attrs):
+        return (attrs.get("notifications_enabled") == "1",
+                int(attrs.get("scheduled_downtime_depth", 0)),
+                attrs.get("problem_has_been_acknowledged") == "1")
+
+    def _load(self, fp):
+        hosts = {}
+        services = {}
+        host_services = {}
+        downtimes = []
+        host_downtimes = {}
+        service_downtimes = {}
+        author_downtimes = {}
+
+        for block_type, attrs in parse_nagios_blocks(fp, self.keys):
+            if block_type == "hoststatus":
+                hosts[attrs.get("host_name")] = self._state(attrs)
+            elif block_type == "servicestatus":
+                host = attrs.get("host_name")
+                svc = attrs.get("service_description")
+                services[(host, svc)] = self._state(attrs)
+                host_services.setdefault(host, []).append(svc)
+            elif block_type in ("hostdowntime", "servicedowntime"):
+                for key in self.downtime_ints:
+                    attrs[key] = int(attrs.get(key, 0))
+                host = attrs.get("host_name")
+                downtimes.append(attrs)
+                host_downtimes.setdefault(host, []).append(attrs)
+                author_downtimes.setdefault(attrs.get("author"),
+                                            []).append(attrs)
+                if "service_description" in attrs:
+                    key = (host, attrs["service_description"])
+                    service_downtimes.setdefault(key, []).append(attrs)
+
+        self.hosts = hosts
+        self.services = services
+        self.host_services = host_services
+        self.downtimes = downtimes
+        self.host_downtimes = host_downtimes
+        self.service_downtimes = service_downtimes
+        self.author_downtimes = author_downtimes
+
+
+def _object_change(change, key, **attrs):
+    attrs["change"] = change
+    attrs["host_name"] = key[0]
+    if key[1] is not None:
+        attrs["service_description"] = key[1]
+    return attrs
+
+
+def diff_status(old_objects, old_downtimes, objects, downtimes):
+    """
+    List the changes between two status.dat snapshots, as made by
+    StateFeed. Each change is a dict with its kind in "change":
+
+    added - A new host or service, with its notifications_enabled
+      and acknowledged flags
+    removed - A host or service that is gone
+    notifications - notifications_enabled was toggled
+    acknowledgement - acknowledged was toggled
+    downtime_added - New downtime, with the same fields as
+      get_downtimes returns
+    downtime_removed - Downtime that ended or was cancelled, with its
+      downtime_id, host_name and service_description
+
+    Hosts and services are identified by host_name and, for
+    services, service_description.
+    """
+
+    changes = []
+    for key, state in objects.items():
+        old_state = old_objects.get(key)
+        if old_state is None:
+            changes.append(_object_change("added", key,
+                                          notifications_enabled=state[0],
+                                          acknowledged=state[1]))
+            continue
+        if state[0] != old_state[0]:
+            changes.append(_object_change("notifications", key,
+                                          notifications_enabled=state[0]))
+        if state[1] != old_state[1]:
+            changes.append(_object_change("acknowledgement", key,
+                                          acknowledged=state[1]))
+    for key in old_objects:
+        if key not in objects:
+            changes.append(_object_change("removed", key))
+
+    for downtime_id, downtime in downtimes.items():
+        if downtime_id not in old_downtimes:
+            change = dict(downtime)
+            change["change"] = "downtime_added"
+            changes.append(change)
+    for downtime_id, downtime in old_downtimes.items():
+        if downtime_id not in downtimes:
+            change = {"change": "downtime_removed",
+                      "downtime_id": downtime_id,
+                      "host_name": downtime["host_name"]}
+            if "service_description" in downtime:
+                change["service_description"] = \
+                    downtime["service_description"]
+            changes.append(change)
+
+    return changes
+
+
+class StateFeed(object):
+    """
+    The changes between successive status.dat snapshots, for
+    get_state_changes.
+
+    Only the latest snapshot is kept: a (notifications_enabled,
+    acknowledged) tuple for each (host, service) key, where service
+    is None for a host, and the downtime dicts from StatusCache by
+    downtime_id. The changes that led to each of the last `history`
+    snapshots are kept so clients can catch up from any of them.
+
+    Tokens name a snapshot as "<epoch>:<generation>", where the epoch
+    is when the feed started, so tokens from before a minion restart
+    aren't mistaken for current ones.
+    """
+
+    # Number of snapshots to keep the changes for
+    history = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = int(time.time())
+        self.generation = 0
+        self.stamp = None
+        self.objects = {}
+        self.downtimes = {}
+        # (generation, changes since the one before)
+        self.deltas = collections.deque()
+
+    def token(self):
+        return "%d:%d" % (self.epoch, self.generation)
+
+    def update(self, status):
+        """
+        Take a new snapshot from a StatusCache if status.dat changed
+        since the last one.
+        """
+
+        self.lock.acquire()
+        try:
+            if status.stamp == self.stamp:
+                return
+            objects = {}
+            for host, state in status.hosts.items():
+                objects[(host, None)] = (state[0], state[2])
+            for key, state in status.services.items():
+                objects[key] = (state[0], state[2])
+            downtimes = dict([(downtime["downtime_id"], downtime)
+                              for downtime in status.downtimes])
+
+            changes = diff_status(self.objects, self.downtimes, objects,
+                                  downtimes)
+            self.generation += 1
+            self.deltas.append((self.generation, changes))
+            while len(self.deltas) > self.history:
+                self.deltas.popleft()
+            self.objects = objects
+            self.downtimes = downtimes
+            self.stamp = status.stamp
+        finally:
+            self.lock.release()
+
+    def changes_since(self, token):
+        """
+        Return (changes, reset) for a client holding the given token.
+        If the token is unknown or too old to catch up from, reset is
+        True and the changes list everything in the latest snapshot as
+        added.
+        """
+
+        self.lock.acquire()
+        try:
+            try:
+                epoch, generation = [int(part) for part in token.split(":")]
+            except (AttributeError, ValueError):
+                # Not a "epoch:generation" string at all
+                epoch, generation = None, None
+            oldest = self.deltas and self.deltas[0][0] or 1
+            if epoch != self.epoch or not \
+                    oldest - 1 <= generation <= self.generation:
+                return diff_status({}, {}, self.objects, self.downtimes), True
+
+            changes = []
+            for delta_generation, delta in self.deltas:
+                if delta_generation > generation:
+                    changes.extend(delta)
+            return changes, False
+        finally:
+            self.lock.release()
+
+
+class CommandPipe(object):
+    """
+    A long-lived handle on the Nagios command file.
+
+    The FIFO is opened with O_NONBLOCK so a Nagios that is restarting
+    or not reading can't hang the minion. Instead we wait up to
+    `timeout` seconds for a reader to show up or for room in the
+    pipe, and then give up. The descriptor is kept open between calls
+    and reopened when the reader goes away (EPIPE/ENXIO) or when
+    Nagios replaces the FIFO on restart.
+    """
+
+    # Seconds to sleep between attempts to open a FIFO with no reader
+    open_retry = 0.05
+
+    # Largest batch of commands to send in one write
+    chunk_size = PIPE_BUF
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+        self.lock = threading.Lock()
+        self.opens = 0
+
+    def close(self):
+        """
+        Close the descriptor, if it's open
+        """
+
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+    def _is_stale(self):
+        """
+        True if the command file was removed or replaced since we
+        opened it
+        """
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        fst = os.fstat(self.fd)
+        return (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino)
+
+    def _open(self, deadline):
+        """
+        Open the command file, retrying until `deadline` while the
+        FIFO has no reader
+        """
+
+        flags = os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK
+        while True:
+            try:
+                self.fd = os.open(self.path, flags)
+                self.opens += 1
+                return
+            except OSError as e:
+                if e.errno != errno.ENXIO or time.time() >= deadline:
+                    raise
+            time.sleep(self.open_retry)
+
+    def _wait_writable(self, deadline):
+        """
+        Wait until there is room in the pipe, or raise once `deadline`
+        has passed
+        """
+
+        remaining = deadline - time.time()
+        if remaining > 0:
+            select.select([], [self.fd], [], remaining)
+        if time.time() >= deadline:
+            raise IOError(errno.ETIMEDOUT,
+                          "Timed out writing to %s" % self.path)
+
+    def write(self, data):
+        """
+        Write data to the command file, waiting at most `timeout`
+        seconds for the write to make progress. A write of up to
+        PIPE_BUF bytes is never split. Raises IOError or OSError if
+        the data could not be written.
+        """
+
+        self.lock.acquire()
+        try:
+            deadline = time.time() + self.timeout
+            reopened = False
+            if self.fd is not None and self._is_stale():
+                self.close()
+            while data:
+                if self.fd is None:
+                    self._open(deadline)
+                try:
+                    data = data[os.write(self.fd, data):]
+                    deadline = time.time() + self.timeout
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        self._wait_writable(deadline)
+                    elif e.errno in (errno.EPIPE, errno.ENXIO) and \
+                            not reopened:
+                        # Nagios went away, wait for it to come back
+                        self.close()
+                        reopened = True
+                    else:
+                        self.close()
+                        raise
+        finally:
+            self.lock.release()
+
+
+class LivestatusSocket(object):
+    """
+    Sends commands through an MK Livestatus Unix socket instead of
+    the command FIFO.
+
+    Each command goes out as a "COMMAND [time] ..." request, and all
+    of the commands in a chunk are pipelined in one send. Connections
+    are kept open in a small pool and reused across calls. If a send
+    fails part way, for example because the server closed the
+    connection, the rest of the chunk is sent again on a fresh
+    connection, starting from the first command that didn't go out
+    whole, so no command is sent twice. `timeout` bounds connecting
+    and sending.
+    """
+
+    # Largest batch of commands to send in one write
+    chunk_size = 65536
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.opens = 0
+
+    def close(self):
+        """
+        Close every pooled connection
+        """
+
+        self.lock.acquire()
+        try:
+            for sock in self.idle:
+                sock.close()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        self.opens += 1
+        return sock
+
+    def _is_closed(self, sock):
+        """
+        True if the server closed this idle connection
+        """
+
+        readable = select.select([sock], [], [], 0)[0]
+        if not readable:
+            return False
+        try:
+            return not sock.recv(4096)
+        except socket.error:
+            return True
+
+    def _get(self):
+        """
+        Take a live connection from the pool, or open a new one
+        """
+
+        self.lock.acquire()
+        try:
+            while self.idle:
+                sock = self.idle.pop()
+                if not self._is_closed(sock):
+                    return sock
+                sock.close()
+        finally:
+            self.lock.release()
+
+        return self._connect()
+
+    def _put(self, sock):
+        self.lock.acquire()
+        try:
+            self.idle.append(sock)
+        finally:
+            self.lock.release()
+
+    def _send(self, sock, request):
+        """
+        Send as much of request as possible, returning the number of
+        bytes that went out
+        """
+
+        sent = 0
+        try:
+            while sent < len(request):
+                sent += sock.send(request[sent:])
+        except socket.error:
+            pass
+        return sent
+
+    def write(self, data):
+        """
+        Send a chunk of formatted commands. Raises socket.error (an
+        IOError) if they could not be sent.
+        """
+
+        request = b"".join([b"COMMAND " + line + b"\n"
+                            for line in data.splitlines(True)])
+        sock = self._get()
+        sent = self._send(sock, request)
+        if sent < len(request):
+            # The server may have dropped the connection, try once more
+            # on a fresh one. Each request ends with a blank line, so
+            # resend from the end of the last one that went out whole.
+            sock.close()
+            end = request.rfind(b"\n\n", 0, sent)
+            start = end >= 0 and end + 2 or 0
+            sock = self._connect()
+            try:
+                sock.sendall(request[start:])
+            except socket.error:
+                sock.close()
+                raise
+        self._put(sock)
+
+
+# Command transports, selected with the `transport` option
+TRANSPORTS = {"fifo": CommandPipe,
+              "livestatus": LivestatusSocket}
+
+
+class ExternalCommand(object):
+    """
+    An entry in the external command registry.
+
+    name - Nagios command name
+    target - What the leading arguments name: "host" (<host_name>),
+      "service" (<host_name>;<service_description>), "hostgroup",
+      "servicegroup", or None if the command doesn't name an object
+    args - Names of the arguments after the target, in order
+
+    The format template is built once here, so formatting a command
+    is a single string interpolation of the entry time and arguments.
+    """
+
+    target_params = {"host": ["host_name"],
+                     "service": ["host_name", "service_description"],
+                     "hostgroup": ["hostgroup_name"],
+                     "servicegroup": ["servicegroup_name"],
+                     None: []}
+
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.params = self.target_params[target] + list(args)
+        self.template = "[%d] " + name + ";%s" * len(self.params) + "\n"
+        self.syntax = ";".join([name] + ["<%s>" % p for p in self.params])
+
+
+DOWNTIME_ARGS = ["start_time", "end_time", "fixed", "trigger_id",
+                 "duration", "author", "comment"]
+ACK_ARGS = ["sticky", "notify", "persistent", "author", "comment"]
+COMMENT_ARGS = ["persistent", "author", "comment"]
+
+# The external commands we know how to send: (command, target, args)
+# See ExternalCommand for what target and args mean.
+COMMAND_TABLE = [
+    ("SCHEDULE_HOST_DOWNTIME", "host", DOWNTIME_ARGS),
+    ("SCHEDULE_HOST_SVC_DOWNTIME", "host", DOWNTIME_ARGS),
+    ("SCHEDULE_SVC_DOWNTIME", "service", DOWNTIME_ARGS),
+    ("SCHEDULE_HOSTGROUP_HOST_DOWNTIME", "hostgroup", DOWNTIME_ARGS),
+    ("SCHEDULE_HOSTGROUP_SVC_DOWNTIME", "hostgroup", DOWNTIME_ARGS),
+    ("SCHEDULE_SERVICEGROUP_HOST_DOWNTIME", "servicegroup", DOWNTIME_ARGS),
+    ("SCHEDULE_SERVICEGROUP_SVC_DOWNTIME", "servicegroup", DOWNTIME_ARGS),
+    ("SCHEDULE_AND_PROPAGATE_HOST_DOWNTIME", "host", DOWNTIME_ARGS),
+    ("SCHEDULE_AND_PROPAGATE_TRIGGERED_HOST_DOWNTIME", "host",
+     DOWNTIME_ARGS),
+    ("DEL_HOST_DOWNTIME", None, ["downtime_id"]),
+    ("DEL_SVC_DOWNTIME", None, ["downtime_id"]),
+
+    ("ENABLE_NOTIFICATIONS", None, []),
+    ("DISABLE_NOTIFICATIONS", None, []),
+    ("ENABLE_HOST_NOTIFICATIONS", "host", []),
+    ("DISABLE_HOST_NOTIFICATIONS", "host", []),
+    ("ENABLE_HOST_SVC_NOTIFICATIONS", "host", []),
+    ("DISABLE_HOST_SVC_NOTIFICATIONS", "host", []),
+    ("ENABLE_SVC_NOTIFICATIONS", "service", []),
+    ("DISABLE_SVC_NOTIFICATIONS", "service", []),
+    ("ENABLE_HOSTGROUP_HOST_NOTIFICATIONS", "hostgroup", []),
+    ("DISABLE_HOSTGROUP_HOST_NOTIFICATIONS", "hostgroup", []),
+    ("ENABLE_HOSTGROUP_SVC_NOTIFICATIONS", "hostgroup", []),
+    ("DISABLE_HOSTGROUP_SVC_NOTIFICATIONS", "hostgroup", []),
+    ("ENABLE_SERVICEGROUP_HOST_NOTIFICATIONS", "servicegroup", []),
+    ("DISABLE_SERVICEGROUP_HOST_NOTIFICATIONS", "servicegroup", []),
+    ("ENABLE_SERVICEGROUP_SVC_NOTIFICATIONS", "servicegroup", []),
+    ("DISABLE_SERVICEGROUP_SVC_NOTIFICATIONS", "servicegroup", []),
+
+    ("ACKNOWLEDGE_HOST_PROBLEM", "host", ACK_ARGS),
+    ("ACKNOWLEDGE_SVC_PROBLEM", "service", ACK_ARGS),
+    ("REMOVE_HOST_ACKNOWLEDGEMENT", "host", []),
+    ("REMOVE_SVC_ACKNOWLEDGEMENT", "service", []),
+    ("ADD_HOST_COMMENT", "host", COMMENT_ARGS),
+    ("ADD_SVC_COMMENT", "service", COMMENT_ARGS),
+    ("DEL_HOST_COMMENT", None, ["comment_id"]),
+    ("DEL_SVC_COMMENT", None, ["comment_id"]),
+
+    ("SCHEDULE_HOST_CHECK", "host", ["check_time"]),
+    ("SCHEDULE_FORCED_HOST_CHECK", "host", ["check_time"]),
+    ("SCHEDULE_SVC_CHECK", "service", ["check_time"]),
+    ("SCHEDULE_FORCED_SVC_CHECK", "service", ["check_time"]),
+    ("SCHEDULE_FORCED_HOST_SVC_CHECKS", "host", ["check_time"]),
+    ("ENABLE_HOST_CHECK", "host", []),
+    ("DISABLE_HOST_CHECK", "host", []),
+    ("ENABLE_SVC_CHECK", "service", []),
+    ("DISABLE_SVC_CHECK", "service", []),
+    ("PROCESS_HOST_CHECK_RESULT", "host", ["status_code", "plugin_output"]),
+    ("PROCESS_SERVICE_CHECK_RESULT", "service",
+     ["return_code", "plugin_output"]),
+]
+
+COMMANDS = dict([(name, ExternalCommand(name, target, args))
+                 for (name, target, args) in COMMAND_TABLE])
+
+
+class Nagios(func_module.FuncModule):
+    """
+    Perform common tasks in Nagios related to downtime and
+    notifications.
+
+    The complete set of external commands Nagios handles is documented
+    on their website:
+
+    http://old.nagios.org/developerinfo/externalcommands/commandlist.php
+
+    Besides the downtime and notification methods below, every command
+    in the module's command registry can be sent with `send_command`
+    or with the method named after the command in lower case, for
+    example `acknowledge_svc_problem`. `list_commands` lists them.
+
+    Note that in the case of `schedule_svc_downtime`,
+    `enable_svc_notifications`, and `disable_svc_notifications`, the
+    service argument should be passed as a list. Entries in the list
+    may be patterns instead of service names: "re:^Disk " selects the
+    host's services matching that regular expression, and
+    "glob:Disk *" those matching the shell-style glob. Patterns are
+    resolved against objects.cache. These methods return
+    a list with one entry per service: the command that was sent, or a
+    message starting with "Fail:" if that command could not be
+    written. All of the commands are sent with a single open of the
+    command file.
+
+    Configuration:
+
+    If your nagios cmdfile is not /var/spool/nagios/cmd/nagios.cmd you
+    can configure this by creating a file called /etc/func/modules/Nagios.conf
+    that looks like this:
+
+        [main]
+        cmdfile = /path/to/your/nagios.cmd
+
+    Before a command is written its host, service, hostgroup or
+    servicegroup is looked up in Nagios' objects.cache, since Nagios
+    silently ignores commands for objects it doesn't know about.
+    Unknown targets make the call return a "Fail:" message instead.
+    Set `object_cache_file` if objects.cache isn't in the default
+    location, or set `validate_targets = False` to skip the check:
+
+        [main]
+        object_cache_file = /var/lib/nagios/objects.cache
+
+    The current downtime and notification state is read from Nagios'
+    status.dat, which can be configured the same way with
+    `status_file`.
+
+    With `idempotent = True` the enable/disable notification methods
+    check status.dat first and skip commands for objects that are
+    already in the requested state. Skipped commands are reported
+    with a message starting with "Skipped:".
+
+    With `queue = True` commands are handed to a background writer and
+    the methods return straight away, with each result saying which
+    ticket the command was queued under. The writer flushes the queue
+    `queue_interval` seconds (default 0.5) after the first command
+    arrives, or once `queue_size` commands (default 500) are waiting.
+    Duplicate enable/disable commands, and enable/disable pairs for
+    the same target, are coalesced so only the last one is written;
+    other commands are always written. Use `queue_status`
+    to see what became of a ticket.
+
+    Commands can be sent through an MK Livestatus socket instead of
+    the command file. Connections to the socket are kept open and
+    reused:
+
+        [main]
+        transport = livestatus
+        livestatus_socket = /var/spool/nagios/cmd/live
+
+    With `spool = True`, commands that can't be written are saved to
+    `spool_file` (default /var/lib/func/nagios.spool) and retried in
+    order every `spool_interval` seconds (default 10) until they go
+    through, even across minion restarts. Their results start with
+    "Spooled:". Downtime that ends before it can be delivered is
+    dropped. `spool_status` reports how much is waiting.
+
+    With `stats = True` the module keeps call counts and latency
+    histograms for every method, along with counters for the command
+    file I/O. `stats` reports them and `reset_stats` zeroes them.
+
+    Several Nagios instances, each monitoring part of the fleet, can be
+    driven from one minion. Each gets an [instance:NAME] section
+    setting any of cmdfile, cmdfile_timeout, transport,
+    livestatus_socket, object_cache_file, status_file,
+    validate_targets and idempotent. Anything not set is taken from
+    [main]:
+
+        [instance:east]
+        cmdfile = /var/spool/nagios-east/cmd/nagios.cmd
+        object_cache_file = /var/log/nagios-east/objects.cache
+        status_file = /var/log/nagios-east/status.dat
+        hostgroups = east-servers
+
+    The bulk methods send each host's commands to the instance that
+    monitors it: the one listing the host in `hosts` or one of its
+    hostgroups in `hostgroups`, otherwise the first instance whose
+    objects.cache knows the host, otherwise [main]. The instances are
+    written to in parallel. `list_instances` shows where hosts go.
+    `schedule_host_tree_downtime`, `cancel_downtime`,
+    `submit_check_results` and the notification snapshots are routed
+    the same way. The other methods only cover [main]. Instances
+    sharing a status.dat, for example one inherited from [main], are
+    one Nagios as far as downtime ids and notification flags go:
+    commands based on them are sent through the first of them.
+
+    Recurring maintenance windows can be registered with
+    `add_maintenance`. The minion schedules each window's downtime
+    `maintenance_lead` seconds (default 300) before it starts, and
+    keeps the definitions in `maintenance_file` (default
+    /var/lib/func/nagios-maintenance.json).
+
+    The methods that return a result for every command they send,
+    like `schedule_svc_downtime` and the bulk methods, can return a
+    summary instead: counts of the commands written, queued, spooled,
+    skipped and failed, the targets with failures, a digest of the
+    full results and a "results_id". The full results can then be
+    fetched a page at a time with `get_results`. Pass verbose=False
+    as the last argument for a summary, or set `verbose = False` to
+    make summaries the default.
+
+    Set `rate_limit` to the number of command lines per second to
+    write at most, to keep a huge batch from filling Nagios' external
+    command buffer. Up to `rate_burst` lines (default 1000) go out at
+    once before the limit applies. Commands waiting for the limit are
+    written in priority order: `priority_notifications` (default 0)
+    for the notification toggles, then `priority_other` (1) and
+    `priority_downtime` (2), lowest first. `pacing_status` shows the
+    backlog:
+
+        [main]
+        rate_limit = 2000
+
+    `snapshot_notification_state` saves the notification flags of a
+    set of hosts and services to a file of its own in `snapshot_dir`
+    (default /var/lib/func/nagios-snapshots), and
+    `restore_notification_state` later puts back just the flags that
+    changed since. Snapshots are kept until
+    `delete_notification_snapshot` removes them.
+
+    Writing a command only means Nagios can read it. To wait until
+    Nagios has actually processed the commands a method sends, call
+    the method through `confirm`, which watches `log_file` (default
+    /var/log/nagios/nagios.log) for them for up to `confirm_timeout`
+    seconds (default 10). Nagios has to be running with
+    log_external_commands=1.
+
+    The command file is kept open between calls. If Nagios isn't
+    reading from it (for instance while it restarts) commands wait up
+    to `cmdfile_timeout` seconds (default 5) before failing, rather
+    than hanging the minion. The same timeout applies to the
+    Livestatus socket:
+
+        [main]
+        cmdfile_timeout = 10
+
+    Examples:
+
+    import func.overlord.client as fc
+    nagios_server = fc.Client("nagios.mydomain.com")
+
+    # Schedule 1 hour of downtime for the http service on www01.
+    nagios_server.schedule_svc_downtime("www01.ext.mydomain.com",
+          ["http"], 60):
+
+    # Schedule 30 minutes (default) of downtime for the rsync
+    # and nfs services on filer05.
+    nagios_server.schedule_svc_downtime("filer05.int.mydomain.com",
+          ["rsync", "nfs"]):
+
+    # Schedule 30 minutes (default) of downtime the foobar host.
+    nagios_server.schedule_host_downtime("foobar.mydomain.com")
+
+    # Reenable notifications for all services on the foobar host.
+    nagios_server.enable_host_svc_notifications("foobar.mydomain.com")
+
+    # Disable notifications for the foo and bar services on the
+    # megafrobber host.
+    nagios_server.disable_svc_notifications("megafrobber.mydomain.com",
+          ["foo", "bar"])
+
+    # Schedule 2 hours of downtime for the www01 and www02 hosts and
+    # for the nfs service on filer05, all in one call.
+    nagios_server.schedule_downtime_bulk({"www01.ext.mydomain.com": [],
+          "www02.ext.mydomain.com": [],
+          "filer05.int.mydomain.com": ["nfs"]}, 120)
+
+    # Reenable host notifications for a list of hosts.
+    nagios_server.enable_notifications_bulk(["www01.ext.mydomain.com",
+          "www02.ext.mydomain.com"])
+    """
+
+    version = "0.8.0"
+    api_version = "0.8.0"
+    description = "Schedule downtime and handle notifications in Nagios."
+
+    class Config(BaseConfig):
+        cmdfile = Option("/var/spool/nagios/cmd/nagios.cmd")
+        cmdfile_timeout = FloatOption(5.0)
+        object_cache_file = Option("/var/log/nagios/objects.cache")
+        validate_targets = BoolOption(True)
+        status_file = Option("/var/log/nagios/status.dat")
+        idempotent = BoolOption(False)
+        queue = BoolOption(False)
+        queue_interval = FloatOption(0.5)
+        queue_size = IntOption(500)
+        transport = Option("fifo")
+        livestatus_socket = Option("/var/spool/nagios/cmd/live")
+        spool = BoolOption(False)
+        spool_file = Option("/var/lib/func/nagios.spool")
+        spool_interval = FloatOption(10.0)
+        stats = BoolOption(False)
+        maintenance_file = Option("/var/lib/func/nagios-maintenance.json")
+        maintenance_lead = IntOption(300)
+        verbose = BoolOption(True)
+        log_file = Option("/var/log/nagios/nagios.log")
+        snapshot_dir = Option("/var/lib/func/nagios-snapshots")
+        confirm_timeout = FloatOption(10.0)
+        rate_limit = FloatOption(0.0)
+        rate_burst = IntOption(1000)
+        priority_notifications = IntOption(0)
+        priority_other = IntOption(1)
+        priority_downtime = IntOption(2)
+
+    def __init__(self):
+        func_module.FuncModule.__init__(self)
+        self._name = "main"
+        self._open_instance()
+        if self.options.spool:
+            self._spool = CommandSpool(self.options.spool_file,
+                                       self._write_commands, self._now,
+                                       self.options.spool_interval)
+        else:
+            self._spool = None
+        self._queue = CommandQueue(self._deliver,
+                                   self.options.queue_interval,
+                                   self.options.queue_size)
+        self._maintenance = MaintenanceScheduler(
+            self.options.maintenance_file, self.options.maintenance_lead,
+            self._submit_maintenance)
+        self._results = ResultStore()
+        self._log_watcher = None
+        self._state_feed = StateFeed()
+        self._snapshot_lock = threading.Lock()
+        self._stats = None
+        self._opens_at_reset = 0
+        if self.options.stats:
+            self._stats = Stats()
+        self._shards = self._read_instances(CONFIG_FILE)
+        self._routes = {}
+        self._routes_stamp = None
+        if self.options.stats:
+            self._instrument()
+
+    def _open_instance(self):
+        """
+        Set up the transport and the objects.cache and status.dat
+        indexes from self.options.
+        """
+
+        if self.options.transport == "livestatus":
+            path = self.options.livestatus_socket
+        else:
+            path = self.options.cmdfile
+        self._transport = TRANSPORTS[self.options.transport](
+            path, self.options.cmdfile_timeout)
+        self._objects = ObjectCache(self.options.object_cache_file)
+        self._status = StatusCache(self.options.status_file)
+        # (host, service) -> (notifications enabled, time sent) for
+        # the notification commands sent in idempotent mode
+        self._notif_sent = {}
+        if self.options.rate_limit > 0:
+            self._pacer = CommandPacer(
+                self.options.rate_limit, self.options.rate_burst,
+                {"notifications": self.options.priority_notifications,
+                 "other": self.options.priority_other,
+                 "downtime": self.options.priority_downtime})
+        else:
+            self._pacer = None
+
+    def _read_instances(self, path):
+        """
+        Set up a shard for each [instance:NAME] section in the module's
+        configuration file. A shard is a Nagios object with its own
+        transport and indexes, and without the queue, spool or
+        maintenance scheduler, which belong to the main instance.
+
+        Returns the shards in the order their sections appear.
+        """
+
+        parser = RawConfigParser()
+        parser.read(path)
+
+        shards = []
+        for section in parser.sections():
+            if not section.startswith(INSTANCE_SECTION):
+                continue
+            shard = Nagios.__new__(Nagios)
+            shard._name = section[len(INSTANCE_SECTION):]
+            shard.options = copy.copy(self.options)
+            for key in INSTANCE_OPTIONS:
+                if parser.has_option(section, key):
+                    option = getattr(self.Config, key)
+                    setattr(shard.options, key,
+                            option.parse(parser.get(section, key)))
+            shard.options.queue = False
+            shard._open_instance()
+            shard._spool = None
+            shard._queue = None
+            shard._maintenance = None
+            shard._stats = self._stats
+            shard._shards = []
+            shard._hosts = []
+            shard._hostgroups = []
+            if parser.has_option(section, "hosts"):
+                shard._hosts = _split_members(parser.get(section, "hosts"))
+            if parser.has_option(section, "hostgroups"):
+                shard._hostgroups = _split_members(
+                    parser.get(section, "hostgroups"))
+            shards.append(shard)
+
+        return shards
+
+    def _route_table(self):
+        """
+        Map host names to the shard that monitors them.
+
+        A host listed in an instance's `hosts`, or a member of one of
+        its `hostgroups`, goes to that instance. Any other host goes
+        to the first instance whose objects.cache knows it, counting
+        only instances with an objects.cache of their own rather than
+        the one inherited from [main]. Hosts missing from the table
+        belong to the main instance. The table is rebuilt when an
+        objects.cache changes.
+        """
+
+        self._objects.refresh()
+        for shard in self._shards:
+            shard._objects.refresh()
+        stamp = [self._objects.stamp] + [shard._objects.stamp
+                                         for shard in self._shards]
+        if stamp == self._routes_stamp:
+            return self._routes
+
+        routes = {}
+        for shard in self._shards:
+            if shard.options.object_cache_file == \
+                    self.options.object_cache_file:
+                continue
+            for host in shard._objects.host_services:
+                routes.setdefault(host, shard)
+        # In reverse, so the first instance to claim a host wins. A
+        # hostgroup's members are looked up in the instance's own
+        # objects.cache first, then in the others.
+        for shard in reversed(self._shards):
+            for hostgroup in shard._hostgroups:
+                for instance in [shard, self] + self._shards:
+                    hosts = instance._objects.hostgroups.get(hostgroup)
+                    if hosts is not None:
+                        break
+                for host in hosts or ():
+                    routes[host] = shard
+        for shard in reversed(self._shards):
+            for host in shard._hosts:
+                routes[host] = shard
+
+        self._routes = routes
+        self._routes_stamp = stamp
+        return routes
+
+    def _status_owner(self, instance):
+        """
+        The instance that owns instance's status.dat: the first one,
+        starting with the main instance, reading the same file.
+        Downtime ids and notification flags in a status.dat belong to
+        the Nagios that wrote it, so commands based on them must go
+        through its owner.
+        """
+
+        for owner in [self] + self._shards:
+            if owner.options.status_file == instance.options.status_file:
+                return owner
+        return instance
+
+    def _per_instance(self, targets, run, by_status=False):
+        """
+        Split the targets of a bulk method between the Nagios
+        instances and merge the results.
+
+        run is called as run(instance, targets) for each instance with
+        targets routed to it, and returns a dict of results by host.
+        When more than one instance is involved each gets its own
+        thread, so the call takes as long as the slowest instance
+        rather than all of them together.
+
+        by_status - Route each host to the owner of its instance's
+          status.dat instead, for methods acting on status.dat
+        """
+
+        if not self._shards:
+            return run(self, targets)
+
+        routes = self._route_table()
+        instances = []
+        instance_targets = {}
+        for host, services in self._bulk_targets(targets):
+            instance = routes.get(host, self)
+            if by_status:
+                instance = self._status_owner(instance)
+            if id(instance) not in instance_targets:
+                instances.append(instance)
+                instance_targets[id(instance)] = {}
+            instance_targets[id(instance)][host] = services
+
+        if len(instances) == 1:
+            return run(instances[0], instance_targets[id(instances[0])])
+
+        outcomes = [None] * len(instances)
+
+        def work(i, instance, targets):
+            try:
+                outcomes[i] = run(instance, targets)
+            except Exception as e:
+                outcomes[i] = dict([(host, ["Fail: instance %s: %s" % (
+                    instance._name, e)]) for host in targets])
+
+        threads = []
+        for i, instance in enumerate(instances):
+            thread = threading.Thread(
+                target=work,
+                args=(i, instance, instance_targets[id(instance)]))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        bulk_results = {}
+        for outcome in outcomes:
+            bulk_results.update(outcome)
+        return bulk_results
+
+    def _instrument(self):
+        """
+        Replace each public method on this instance with one that
+        records its calls in self._stats. When the `stats` option is
+        off this never happens, so there is no cost at all.
+        """
+
+        for name in dir(self):
+            if name[0] == "_" or name in ("register_rpc", "get_method_args",
+                                          "stats", "reset_stats"):
+                continue
+            method = getattr(self, name)
+            if not isinstance(method, types.MethodType):
+                continue
+            timed = _timed_method(self._stats, name, method)
+            setattr(self, name, types.MethodType(timed, self))
+
+    def _now(self):
+        """
+        The time in seconds since 12:00:00AM Jan 1, 1970
+        """
+
+        return int(time.time())
+
+    def _chunk_commands(self, cmds):
+        """
+        Split a list of formatted commands into chunks that each end on
+        a line boundary and fit in the transport's chunk size (PIPE_BUF
+        bytes for the FIFO). A command longer than that is put in a
+        chunk of its own.
+        """
+
+        chunk_size = self._transport.chunk_size
+        chunks = []
+        chunk = []
+        size = 0
+        for cmd in cmds:
+            cmd_len = len(_encode(cmd))
+            if chunk and size + cmd_len > chunk_size:
+                chunks.append(chunk)
+                chunk = []
+                size = 0
+            chunk.append(cmd)
+            size += cmd_len
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def _write_commands(self, cmds):
+        """
+        Write a batch of formatted commands to the Nagios command file,
+        or whichever transport is configured.
+
+        Each chunk from `_chunk_commands` goes out in a single write()
+        so Nagios never sees it torn. If a chunk can't be written the
+        rest of the batch is not attempted, so commands are never
+        delivered out of order.
+
+        Returns a list of (written, [cmd, ...]) tuples, one per chunk.
+        """
+
+        stats = self._stats
+        pacer = self._pacer
+        results = []
+        written = True
+        for chunk in self._chunk_commands(cmds):
+            if written:
+                data = _encode("".join(chunk))
+                if pacer is not None:
+                    # A chunk goes at the priority of its most urgent
+                    # command
+                    pacer.acquire(len(chunk), min(
+                        [command_class(cmd) for cmd in chunk],
+                        key=pacer.priorities.get))
+                start = time.time()
+                try:
+                    self._transport.write(data)
+                except (IOError, OSError):
+                    written = False
+                if stats is not None:
+                    stats.record_write(len(chunk), len(data),
+                                       time.time() - start, written)
+            results.append((written, chunk))
+
+        return results
+
+    def _write_command(self, cmd):
+        """
+        Write the given command to the Nagios command file
+        """
+
+        return self._write_commands([cmd])[0][0]
+
+    def _deliver(self, cmds):
+        """
+        Write a batch of formatted commands, falling back to the spool
+        when it's on. Commands go straight to the spool while older
+        commands are still waiting in it, so they are never delivered
+        out of order.
+
+        Returns a list of (status, [cmd, ...]) tuples, one per chunk,
+        where status is "written", "spooled" or "failed".
+        """
+
+        spool = self._spool
+        if spool is not None and spool.depth:
+            try:
+                spool.append(cmds)
+                return [("spooled", cmds)]
+            except (IOError, OSError):
+                return [("failed", cmds)]
+
+        results = []
+        for written, chunk in self._write_commands(cmds):
+            if written:
+                results.append(("written", chunk))
+                continue
+            try:
+                if spool is None:
+                    raise IOError("spool is off")
+                spool.append(chunk)
+                results.append(("spooled", chunk))
+            except (IOError, OSError):
+                results.append(("failed", chunk))
+
+        return results
+
+    def _submit(self, cmds):
+        """
+        Write a batch of formatted commands and return the result for
+        each one: the command itself if its chunk was written, or a
+        message naming the command if it was spooled or could not be
+        written.
+
+        With the `queue` option on the commands are queued for the
+        background writer instead, and each result says which ticket
+        they were queued under.
+        """
+
+        if self.options.queue:
+            ticket = self._queue.put(cmds)
+            return ["Queued as ticket %d: %s" % (ticket, cmd)
+                    for cmd in cmds]
+
+        results = []
+        for status, chunk in self._deliver(cmds):
+            for cmd in chunk:
+                if status == "written":
+                    results.append(cmd)
+                elif status == "spooled":
+                    results.append("%s: %s" % (SPOOLED, cmd))
+                else:
+                    results.append("%s: %s" % (WRITE_FAIL, cmd))
+
+        return results
+
+    def _expand_services(self, host, services):
+        """
+        Replace the patterns in a list of services with the host's
+        services that match them, according to objects.cache. Plain
+        service names are kept as they are, and each service is listed
+        once.
+
+        Returns a (services, error) tuple, where error is a failure
+        message or an empty string.
+        """
+
+        try:
+            matchers = [service_matcher(service) for service in services]
+        except re.error as e:
+            return services, "Fail: bad service pattern: %s" % e
+        if not [matcher for matcher in matchers if matcher]:
+            return services, ""
+
+        if not self._objects.refresh():
+            return services, OBJECTS_FAIL
+        known_services = self._objects.host_services.get(host)
+        if known_services is None:
+            return services, "Fail: unknown host: %s" % host
+
+        expanded = []
+        seen = set()
+        for service, matcher in zip(services, matchers):
+            if matcher is None:
+                matches = [service]
+            else:
+                matches = sorted([svc for svc in known_services
+                                  if matcher(svc)])
+            for svc in matches:
+                if svc not in seen:
+                    seen.add(svc)
+                    expanded.append(svc)
+
+        # An empty list would mean the host itself to the bulk methods
+        if not expanded:
+            return services, "Fail: no services on %s match: %s" % (
+                host, ", ".join(services))
+        return expanded, ""
+
+    def _check_target(self, kind, name, services=[]):
+        """
+        Look up the target of a command in objects.cache, since Nagios
+        silently ignores commands for objects it doesn't know.
+
+        kind - One of "host", "hostgroup" or "servicegroup"
+        name - Name of the target
+        services - Services on a host target that must also exist
+
+        Returns a failure message if the target is unknown, otherwise
+        an empty string. Nothing is checked if `validate_targets` is
+        off or objects.cache can't be read.
+        """
+
+        if not self.options.validate_targets or not self._objects.refresh():
+            return ""
+
+        if kind == "host":
+            known_services = self._objects.host_services.get(name)
+            if known_services is None:
+                return "Fail: unknown host: %s" % name
+            unknown = [svc for svc in services if svc not in known_services]
+            if unknown:
+                return "Fail: unknown service(s) on %s: %s" % (
+                    name, ", ".join(unknown))
+        elif kind == "hostgroup":
+            if name not in self._objects.hostgroups:
+                return "Fail: unknown hostgroup: %s" % name
+        elif kind == "servicegroup":
+            if name not in self._objects.servicegroups:
+                return "Fail: unknown servicegroup: %s" % name
+
+        return ""
+
+    def _submit_bulk(self, target_cmds, bulk_results):
+        """
+        Write the commands for many targets as one batch.
+
+        target_cmds is a list of (target, cmd) tuples. The results for
+        each target's commands are added to the bulk_results dict,
+        which is returned.
+        """
+
+        results = self._submit([cmd for (target, cmd) in target_cmds])
+        for (target, cmd), result in zip(target_cmds, results):
+            bulk_results.setdefault(target, []).append(result)
+
+        return bulk_results
+
+    def _bulk_targets(self, targets):
+        """
+        Normalize the targets of a bulk method into a list of
+        (host, [service, ...]) tuples. targets may be a list of host
+        names or a dict mapping host names to lists of services.
+        """
+
+        if isinstance(targets, dict):
+            return list(targets.items())
+        else:
+            return [(host, []) for host in targets]
+
+    def _notif_objects(self, cmd, target, svc=None):
+        """
+        Expand the target of an ENABLE_/DISABLE_*_NOTIFICATIONS command
+        into the (host, service) objects whose notification flag it
+        sets. The service is None for a host. Returns None if the
+        target can't be expanded.
+        """
+
+        kind = cmd.split("_", 1)[1]
+        if kind == "HOST_NOTIFICATIONS":
+            return [(target, None)]
+        elif kind == "SVC_NOTIFICATIONS":
+            return [(target, svc)]
+        elif kind == "HOST_SVC_NOTIFICATIONS":
+            services = self._status.host_services.get(target)
+            if services is None:
+                return None
+            return [(target, service) for service in services]
+
+        if not self._objects.refresh():
+            return None
+        if kind == "HOSTGROUP_HOST_NOTIFICATIONS":
+            hosts = self._objects.hostgroups.get(target, [])
+            return [(host, None) for host in hosts]
+        elif kind == "HOSTGROUP_SVC_NOTIFICATIONS":
+            hosts = self._objects.hostgroups.get(target, [])
+            return [(host, service) for host in hosts
+                    for service in self._objects.host_services.get(host, [])]
+        elif kind == "SERVICEGROUP_HOST_NOTIFICATIONS":
+            members = self._objects.servicegroups.get(target, [])
+            return [(host, None) for host in set([m[0] for m in members])]
+        elif kind == "SERVICEGROUP_SVC_NOTIFICATIONS":
+            return list(self._objects.servicegroups.get(target, []))
+
+        return None
+
+    def _notif_enabled(self, obj):
+        """
+        Whether notifications are enabled for a (host, service)
+        object, or None if we don't know.
+
+        status.dat is only rewritten every status_update_interval, so
+        commands we sent since it was last written take precedence
+        over what it says.
+        """
+
+        if obj in self._notif_sent:
+            enabled, sent = self._notif_sent[obj]
+            if sent >= self._status.stamp[0]:
+                return enabled
+            self._notif_sent.pop(obj, None)
+
+        if obj[1] is None:
+            state = self._status.hosts.get(obj[0])
+        else:
+            state = self._status.services.get(obj)
+        if state is None:
+            return None
+        return state[0]
+
+    def _submit_notif(self, notifs):
+        """
+        Format and write a batch of ENABLE_/DISABLE_*_NOTIFICATIONS
+        commands. notifs is a list of (cmd, target, svc) tuples, where
+        svc is None for commands that don't take a service.
+
+        With the `idempotent` option on, a command is skipped when
+        every object it touches already has the requested state
+        according to status.dat. Its result is then a message
+        starting with "Skipped:" instead of the command.
+        """
+
+        idempotent = self.options.idempotent and self._status.refresh()
+        results = [None] * len(notifs)
+        to_send = []
+        for i, (cmd, target, svc) in enumerate(notifs):
+            notif_str = self._fmt_notif_str(cmd, target, svc=svc)
+            enable = cmd.startswith("ENABLE_")
+            objects = None
+            if idempotent:
+                objects = self._notif_objects(cmd, target, svc)
+            if objects:
+                states = [self._notif_enabled(obj) for obj in objects]
+                if states.count(enable) == len(states):
+                    results[i] = "%s: %s" % (SKIPPED, notif_str)
+                    continue
+            to_send.append((i, notif_str, enable, objects))
+
+        sent = self._submit([notif_str for (i, notif_str, enable, objects)
+                             in to_send])
+        now = time.time()
+        for (i, notif_str, enable, objects), result in zip(to_send, sent):
+            results[i] = result
+            if objects and not result.startswith(WRITE_FAIL):
+                for obj in objects:
+                    self._notif_sent[obj] = (enable, now)
+
+        return results
+
+    def _report(self, target, results, verbose):
+        """
+        Return results as they are, or with `verbose` off a summary of
+        them. results is a list of results for target, or a dict of
+        target -> list of results. A single failure message is always
+        returned as it is.
+
+        verbose - True or False, or None to use the `verbose` option
+        """
+
+        if verbose is None:
+            verbose = self.options.verbose
+        if verbose or not isinstance(results, (list, dict)):
+            return results
+
+        if isinstance(results, list):
+            results = {target: results}
+        summary = summarize_results(results)
+        summary["results_id"] = self._results.add(
+            [result for target in sorted(results)
+             for result in results[target]])
+        return summary
+
+    def _fmt_dt_str(self, cmd, host, duration, author="func",
+                    comment="Scheduling downtime", start=None,
+                    svc=None, fixed=1, trigger=0):
+        """
+        Format an external-command downtime string.
+
+        cmd - Nagios command ID
+        host - Host schedule downtime on
+        duration - Minutes to schedule downtime for
+        author - Name to file the downtime as
+        comment - Reason for running this command (upgrade, reboot, etc)
+        start - Start of downtime in seconds since 12:00AM Jan 1 1970
+          Default is to use the entry time (now)
+        svc - Service to schedule downtime for, omit when for host downtime
+        fixed - Start now if 1, start when a problem is detected if 0
+        trigger - Optional ID of event to start downtime from. Leave as 0 for
+          fixed downtime.
+
+        Syntax: [submitted] COMMAND;<host_name>;[<service_description>]
+        <start_time>;<end_time>;<fixed>;<trigger_id>;<duration>;<author>;
+        <comment>
+        """
+
+        entry_time = self._now()
+        if start is None:
+            start = entry_time
+
+        duration_s = duration * 60
+        end = start + duration_s
+        template = COMMANDS[cmd].template
+
+        if svc is not None:
+            return template % (entry_time, host, svc, start, end, fixed,
+                               trigger, duration_s, author, comment)
+        else:
+            # Downtime for a host if no svc specified
+            return template % (entry_time, host, start, end, fixed,
+                               trigger, duration_s, author, comment)
+
+    def _submit_maintenance(self, windows):
+        """
+        Schedule the downtime for a batch of recurring maintenance
+        windows in one write. windows is a list of (definition, start)
+        tuples. Returns a result for each window: the first failure,
+        or else the first result that wasn't a written command (such
+        as a spooled one), or else "ok".
+        """
+
+        cmd_strs = []
+        counts = []
+        for definition, start in windows:
+            cmd = definition["cmd"]
+            comment = "Maintenance window %s" % definition["id"]
+            if definition["services"]:
+                for service in definition["services"]:
+                    cmd_strs.append(self._fmt_dt_str(
+                        cmd, definition["target"], definition["minutes"],
+                        comment=comment, start=start, svc=service))
+                counts.append(len(definition["services"]))
+            else:
+                cmd_strs.append(self._fmt_dt_str(
+                    cmd, definition["target"], definition["minutes"],
+                    comment=comment, start=start))
+                counts.append(1)
+
+        results = self._submit(cmd_strs)
+        window_results = []
+        for count in counts:
+            window_result = "ok"
+            for cmd_str, result in zip(cmd_strs[:count], results[:count]):
+                if result.startswith("Fail:"):
+                    window_result = result
+                    break
+                if result != cmd_str and window_result == "ok":
+                    window_result = result
+            window_results.append(window_result)
+            cmd_strs = cmd_strs[count:]
+            results = results[count:]
+
+        return window_results
+
+    def _fmt_cmd(self, cmd, *args):
+        """
+        Format any external command in the registry. args are the
+        command's arguments in the order Nagios expects them.
+        """
+
+        return COMMANDS[cmd].template % ((self._now(),) + args)
+
+    def _fmt_check_result(self, host, svc, code, output):
+        """
+        Format a PROCESS_SERVICE_CHECK_RESULT command, or a
+        PROCESS_HOST_CHECK_RESULT command if svc is None, escaping the
+        plugin output.
+        """
+
+        if svc is not None:
+            return COMMANDS["PROCESS_SERVICE_CHECK_RESULT"].template % (
+                self._now(), host, svc, code, escape_output(output))
+        else:
+            return COMMANDS["PROCESS_HOST_CHECK_RESULT"].template % (
+                self._now(), host, code, escape_output(output))
+
+    def _check_results(self, targets):
+        """
+        Format and write passive check results for one instance.
+        targets maps host names to lists of (service, code, output)
+        tuples, where service is None for a host check result.
+
+        Returns a dict mapping each host to the list of results for
+        its commands.
+        """
+
+        validate = self.options.validate_targets and self._objects.refresh()
+        host_services = self._objects.host_services
+        target_cmds = []
+        bulk_results = {}
+        for host, checks in targets.items():
+            for svc, code, output in checks:
+                error = ""
+                if validate and host not in host_services:
+                    error = "Fail: unknown host: %s" % host
+                elif validate and svc is not None and \
+                        svc not in host_services[host]:
+                    error = "Fail: unknown service(s) on %s: %s" % (host, svc)
+                else:
+                    try:
+                        code = int(code)
+                    except (TypeError, ValueError):
+                        code = -1
+                    if not 0 <= code <= (svc is None and 2 or 3):
+                        error = "Fail: bad return code for %s%s" % (
+                            host, svc is not None and ";" + svc or "")
+                    elif "\n" in host + (svc or "") or \
+                            ";" in host + (svc or ""):
+                        error = "Fail: bad host or service name: %s" % host
+                if error:
+                    bulk_results.setdefault(host, []).append(error)
+                    continue
+                target_cmds.append((host, self._fmt_check_result(
+                    host, svc, code, output)))
+
+        return self._submit_bulk(target_cmds, bulk_results)
+
+    def _fmt_notif_str(self, cmd, host, svc=None):
+        """
+        Format an external-command notification string.
+
+        cmd - Nagios command ID.
+        host - Host to en/disable notifications on..
+        svc - Service to schedule downtime for. A value is not required
+          for host downtime.
+
+        Syntax: [submitted] COMMAND;<host_name>[;<service_description>]
+        """
+
+        if svc is not None:
+            return COMMANDS[cmd].template % (self._now(), host, svc)
+        else:
+            # Host or group notifications if no svc specified
+            return COMMANDS[cmd].template % (self._now(), host)
+
+    def _schedule_downtime(self, cmd, target, services, minutes):
+        """
+        Shared implementation of the schedule_*_downtime methods.
+        services is a list for SCHEDULE_SVC_DOWNTIME and None for the
+        commands that don't take a service.
+        """
+
+        kind = COMMANDS[cmd].target
+        if kind == "service":
+            services, error = self._expand_services(target, services)
+            if not error:
+                error = self._check_target("host", target, services)
+            if error:
+                return error
+            return self._submit([self._fmt_dt_str(cmd, target, minutes,
+                                                  svc=service)
+                                 for service in services])
+
+        error = self._check_target(kind, target)
+        if error:
+            return error
+        return self._submit([self._fmt_dt_str(cmd, target, minutes)])[0]
+
+    def _set_notifications(self, cmd, target, services):
+        """
+        Shared implementation of the enable/disable_*_notifications
+        methods. services is a list for the _SVC_NOTIFICATIONS
+        commands and None for the commands that don't take a service.
+        """
+
+        kind = COMMANDS[cmd].target
+        if kind == "service":
+            services, error = self._expand_services(target, services)
+            if not error:
+                error = self._check_target("host", target, services)
+            if error:
+                return error
+            return self._submit_notif([(cmd, target, service)
+                                       for service in services])
+
+        error = self._check_target(kind, target)
+        if error:
+            return error
+        return self._submit_notif([(cmd, target, None)])[0]
+
+    def _downtime_bulk(self, targets, minutes):
+        """
+        Implementation of schedule_downtime_bulk for one instance.
+        """
+
+        target_cmds = []
+        bulk_results = {}
+        for host, services in self._bulk_targets(targets):
+            services, error = self._expand_services(host, services)
+            if not error:
+                error = self._check_target("host", host, services)
+            if error:
+                bulk_results[host] = [error]
+                continue
+
+            if services:
+                for service in services:
+                    dt_cmd_str = self._fmt_dt_str("SCHEDULE_SVC_DOWNTIME",
+                                                  host, minutes, svc=service)
+                    target_cmds.append((host, dt_cmd_str))
+            else:
+                dt_cmd_str = self._fmt_dt_str("SCHEDULE_HOST_DOWNTIME",
+                                              host, minutes)
+                target_cmds.append((host, dt_cmd_str))
+
+        return self._submit_bulk(target_cmds, bulk_results)
+
+    def schedule_downtime_bulk(self, targets, minutes=30, verbose=None):
+        """
+        Schedule downtime for many hosts and services in one call.
+
+        targets is either a list of host names, to schedule host
+        downtime for each of them, or a dict mapping host names to
+        lists of services to schedule downtime for. A host mapped to
+        an empty list gets host downtime. Services may be patterns, as
+        for schedule_svc_downtime.
+
+        Every command is written to the command file in one batch, or
+        with several Nagios instances configured, one batch per
+        instance.
+        Returns a dict mapping each host to the list of results for
+        its commands.
+        """
+
+        return self._report(None, self._per_instance(
+            targets, lambda instance, targets:
+            instance._downtime_bulk(targets, minutes)), verbose)
+
+    def _notifications_bulk(self, action, targets):
+        """
+        Shared implementation of the en/disable_notifications_bulk
+        methods. action is either "ENABLE" or "DISABLE".
+        """
+
+        notifs = []
+        bulk_results = {}
+        for host, services in self._bulk_targets(targets):
+            services, error = self._expand_services(host, services)
+            if not error:
+                error = self._check_target("host", host, services)
+            if error:
+                bulk_results[host] = [error]
+                continue
+
+            if services:
+                cmd = "%s_SVC_NOTIFICATIONS" % action
+                for service in services:
+                    notifs.append((cmd, host, service))
+            else:
+                cmd = "%s_HOST_NOTIFICATIONS" % action
+                notifs.append((cmd, host, None))
+
+        results = self._submit_notif(notifs)
+        for (cmd, host, svc), result in zip(notifs, results):
+            bulk_results.setdefault(host, []).append(result)
+
+        return bulk_results
+
+    def disable_notifications_bulk(self, targets, verbose=None):
+        """
+        Disable notifications for many hosts and services in one call.
+
+        targets is either a list of host names, to disable host
+        notifications for each of them, or a dict mapping host names
+        to lists of services to disable notifications for. A host
+        mapped to an empty list has its host notifications disabled.
+        Services may be patterns, as for disable_svc_notifications.
+
+        Every command is written to the command file in one batch, or
+        with several Nagios instances configured, one batch per
+        instance. Returns a dict mapping each host to the list of
+        results for its commands.
+        """
+
+        return self._report(None, self._per_instance(
+            targets, lambda instance, targets:
+            instance._notifications_bulk("DISABLE", targets)), verbose)
+
+    def enable_notifications_bulk(self, targets, verbose=None):
+        """
+        Enable notifications for many hosts and services in one call.
+
+        targets is either a list of host names, to enable host
+        notifications for each of them, or a dict mapping host names
+        to lists of services to enable notifications for. A host
+        mapped to an empty list has its host notifications enabled.
+        Services may be patterns, as for enable_svc_notifications.
+
+        Every command is written to the command file in one batch, or
+        with several Nagios instances configured, one batch per
+        instance. Returns a dict mapping each host to the list of
+        results for its commands.
+        """
+
+        return self._report(None, self._per_instance(
+            targets, lambda instance, targets:
+            instance._notifications_bulk("ENABLE", targets)), verbose)
+
+    def get_host_services(self, host):
+        """
+        List the services Nagios has configured for the given host,
+        according to objects.cache.
+        """
+
+        if not self._objects.refresh():
+            return OBJECTS_FAIL
+        services = self._objects.host_services.get(host)
+        if services is None:
+            return "Fail: unknown host: %s" % host
+        return sorted(services)
+
+    def get_hostgroup_members(self, hostgroup):
+        """
+        List the hosts in the given hostgroup, according to
+        objects.cache.
+        """
+
+        if not self._objects.refresh():
+            return OBJECTS_FAIL
+        hosts = self._objects.hostgroups.get(hostgroup)
+        if hosts is None:
+            return "Fail: unknown hostgroup: %s" % hostgroup
+        return sorted(hosts)
+
+    def get_servicegroup_members(self, servicegroup):
+        """
+        List the members of the given servicegroup as [host, service]
+        pairs, according to objects.cache.
+        """
+
+        if not self._objects.refresh():
+            return OBJECTS_FAIL
+        members = self._objects.servicegroups.get(servicegroup)
+        if members is None:
+            return "Fail: unknown servicegroup: %s" % servicegroup
+        return [list(member) for member in sorted(members)]
+
+    def get_downtimes(self, host=None, service=None):
+        """
+        List the downtime Nagios currently has scheduled, according to
+        status.dat. Pass a host to only list downtime for that host
+        and its services, and a service as well to only list downtime
+        for that service.
+
+        Each downtime is a dict with the downtime_id, host_name,
+        service_description (for service downtime), entry_time,
+        start_time, end_time, fixed, triggered_by, duration, author
+        and comment.
+        """
+
+        if not self._status.refresh():
+            return STATUS_FAIL
+
+        if host:
+            downtimes = self._status.host_downtimes.get(host, [])
+        else:
+            downtimes = self._status.downtimes
+
+        if service:
+            downtimes = [dt for dt in downtimes
+                         if dt.get("service_description") == service]
+
+        return [dict(dt) for dt in downtimes]
+
+    def get_notification_state(self, host, services=None):
+        """
+        Report whether notifications are enabled for a host and its
+        services, according to status.dat. Pass a list of services to
+        only report on those, otherwise every service on the host is
+        reported.
+
+        Returns a dict like:
+
+            {"host": True,
+             "services": {"HTTP": True, "Minecraft": False},
+             "unknown": []}
+
+        where "unknown" lists requested services Nagios doesn't have.
+        """
+
+        if not self._status.refresh():
+            return STATUS_FAIL
+
+        host_state = self._status.hosts.get(host)
+        if host_state is None:
+            return "Fail: unknown host: %s" % host
+
+        if not services:
+            services = self._status.host_services.get(host, [])
+
+        svc_states = {}
+        unknown = []
+        for svc in services:
+            svc_state = self._status.services.get((host, svc))
+            if svc_state is None:
+                unknown.append(svc)
+            else:
+                svc_states[svc] = svc_state[0]
+
+        return {"host": host_state[0],
+                "services": svc_states,
+                "unknown": unknown}
+
+    def queue_status(self, ticket):
+        """
+        Report what happened to the commands queued under a ticket
+        when the `queue` option is on.
+
+        Returns a dict counting the ticket's commands that are still
+        "queued", were "written", "failed" to be written, were
+        "spooled" for a retry, or were "coalesced" away because a later
+        command superseded them.
+        """
+
+        counts = self._queue.status(ticket)
+        if counts is None:
+            return "Fail: unknown ticket: %s" % ticket
+        return counts
+
+    def send_command(self, cmd, *args):
+        """
+        Send any external command in the command registry. args are
+        the command's arguments in the order Nagios expects them,
+        `list_commands` shows the syntax of every supported command.
+
+        For example, to acknowledge a problem with the HTTP service on
+        www01 (sticky, notify and persistent):
+
+            send_command("ACKNOWLEDGE_SVC_PROBLEM", "www01", "HTTP",
+                         2, 1, 1, "tim", "Looking into it")
+
+        Each command also has its own method named after it in lower
+        case, so the same can be done with
+        acknowledge_svc_problem("www01", "HTTP", 2, 1, 1, "tim",
+        "Looking into it").
+        """
+
+        return self._send_command(cmd, args)
+
+    def _send_command(self, cmd, args):
+        """
+        Shared implementation of `send_command` and the methods
+        generated for each command in the registry
+        """
+
+        command = COMMANDS.get(cmd)
+        if command is None:
+            return "Fail: unsupported command: %s" % cmd
+        if len(args) != len(command.params):
+            return "Fail: usage: %s" % command.syntax
+
+        if command.target == "service":
+            error = self._check_target("host", args[0], [args[1]])
+        elif command.target is not None:
+            error = self._check_target(command.target, args[0])
+        else:
+            error = ""
+        if error:
+            return error
+
+        cmd_str = command.template % ((self._now(),) + tuple(args))
+        if cmd_str.count("\n") != 1:
+            return "Fail: arguments can't contain newlines"
+        return self._submit([cmd_str])[0]
+
+    def list_commands(self):
+        """
+        List the external commands `send_command` supports, as a dict
+        mapping each command to its syntax.
+        """
+
+        return dict([(name, command.syntax)
+                     for name, command in COMMANDS.items()])
+
+    def spool_status(self):
+        """
+        Report on the spool of undelivered commands.
+
+        Returns a dict with "enabled", "depth" (the number of commands
+        waiting) and "age" (seconds the oldest of them has waited, 0
+        if none are).
+        """
+
+        spool = self._spool
+        if spool is None:
+            return {"enabled": False, "depth": 0, "age": 0}
+
+        age = 0
+        if spool.oldest is not None:
+            age = self._now() - spool.oldest
+        return {"enabled": True, "depth": spool.depth, "age": age}
+
+    def stats(self):
+        """
+        Report the statistics kept when the `stats` option is on.
+
+        Returns a dict with:
+
+        methods - For each method called: "calls", "errors" (calls
+          that raised or returned a failure), total "seconds", and
+          "latency_ms", a histogram counting calls by the first bucket
+          (in milliseconds) their duration fits in
+        io - "chunks_written", "lines_written", "bytes_written",
+          "write_failures", "blocked_seconds" spent writing to the
+          command file, and "opens" of the command file or socket
+        """
+
+        if self._stats is None:
+            return {"enabled": False}
+
+        report = self._stats.report()
+        report["enabled"] = True
+        report["io"]["opens"] = self._transport.opens - self._opens_at_reset
+        return report
+
+    def reset_stats(self):
+        """
+        Zero the statistics kept when the `stats` option is on.
+        Returns them as they were before the reset.
+        """
+
+        report = self.stats()
+        if self._stats is not None:
+            self._stats.reset()
+            self._opens_at_reset = self._transport.opens
+        return report
+
+    def cancel_downtime(self, host=None, services=None, author=None,
+                        comment_regex=None):
+        """
+        Cancel every scheduled downtime that matches all of the given
+        filters, according to status.dat.
+
+        host - Only downtime for this host and its services
+        services - With host, only downtime for these services
+        author - Only downtime filed under this author, "func" for
+          downtime scheduled by this module
+        comment_regex - Only downtime whose comment matches this
+          regular expression
+
+        At least one of host, author or comment_regex is required, and
+        services can only be given with a host. The
+        DEL_HOST_DOWNTIME/DEL_SVC_DOWNTIME commands for every match are
+        written in one batch. With several Nagios instances configured,
+        the status.dat of the instance monitoring host, or without a
+        host every instance's status.dat, is searched. Each
+        status.dat's matches are cancelled in their own batch, through
+        the first instance reading that status.dat. Returns the list
+        of results, one per cancelled downtime.
+        """
+
+        if not (host or author or comment_regex):
+            return "Fail: give a host, author or comment_regex to match"
+        if services and not host:
+            return "Fail: services can only be matched with a host"
+        pattern = None
+        if comment_regex:
+            try:
+                pattern = re.compile(comment_regex)
+            except re.error:
+                return "Fail: bad comment_regex: %s" % comment_regex
+
+        if not self._shards:
+            return self._cancel_downtime(host, services, author, pattern)
+        if host:
+            instances = [self._status_owner(
+                self._route_table().get(host, self))]
+        else:
+            # One instance per status.dat, so instances sharing one
+            # don't cancel each other's downtime ids
+            instances = [instance for instance in [self] + self._shards
+                         if self._status_owner(instance) is instance]
+        results = []
+        for instance in instances:
+            instance_results = instance._cancel_downtime(host, services,
+                                                         author, pattern)
+            if not isinstance(instance_results, list):
+                instance_results = ["%s (instance %s)" % (
+                    instance_results, instance._name)]
+            results.extend(instance_results)
+        return results
+
+    def _cancel_downtime(self, host, services, author, pattern):
+        """
+        Implementation of cancel_downtime for one instance. pattern is
+        the compiled comment_regex, or None.
+        """
+
+        if not self._status.refresh():
+            return STATUS_FAIL
+
+        if host and services:
+            downtimes = []
+            for service in services:
+                downtimes.extend(self._status.service_downtimes.get(
+                    (host, service), []))
+        elif host:
+            downtimes = self._status.host_downtimes.get(host, [])
+        elif author:
+            downtimes = self._status.author_downtimes.get(author, [])
+        else:
+            downtimes = self._status.downtimes
+
+        if author:
+            downtimes = [dt for dt in downtimes if dt.get("author") == author]
+        if pattern is not None:
+            downtimes = [dt for dt in downtimes
+                         if pattern.search(dt.get("comment", ""))]
+
+        cmd_strs = []
+        for dt in downtimes:
+            if "service_description" in dt:
+                cmd = "DEL_SVC_DOWNTIME"
+            else:
+                cmd = "DEL_HOST_DOWNTIME"
+            cmd_strs.append(self._fmt_cmd(cmd, dt["downtime_id"]))
+
+        return self._submit(cmd_strs)
+
+    def add_maintenance(self, cmd, target, at, minutes, days=[],
+                        services=[]):
+        """
+        Register a recurring maintenance window. The minion schedules
+        its downtime shortly before each window starts, so no cron job
+        or overlord call is needed per window.
+
+        cmd - The downtime command to use, like SCHEDULE_HOST_DOWNTIME
+          or SCHEDULE_HOSTGROUP_SVC_DOWNTIME
+        target - The host, hostgroup or servicegroup
+        at - Local start time of each window, as "HH:MM"
+        minutes - Length of each window, a positive whole number
+        days - Weekdays the window recurs on ("mon" ... "sun"), or an
+          empty list for every day
+        services - Services, for SCHEDULE_SVC_DOWNTIME
+
+        For example, 90 minutes of downtime for the db-servers
+        hostgroup every Sunday at 02:00:
+
+            add_maintenance("SCHEDULE_HOSTGROUP_HOST_DOWNTIME",
+                            "db-servers", "02:00", 90, ["sun"])
+
+        Returns the new definition, including its "id" and the start
+        of its "next_window".
+        """
+
+        command = COMMANDS.get(cmd)
+        if command is None or not cmd.startswith("SCHEDULE_") or \
+                "end_time" not in command.params:
+            return "Fail: not a downtime command: %s" % cmd
+        if (command.target == "service") != bool(services):
+            return "Fail: services are required for, and only for, %s" % (
+                "SCHEDULE_SVC_DOWNTIME")
+        try:
+            hour, minute = [int(part) for part in at.split(":")]
+        except ValueError:
+            return "Fail: bad time, use HH:MM: %s" % at
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            return "Fail: bad time, use HH:MM: %s" % at
+        try:
+            minutes = int(minutes)
+        except (TypeError, ValueError):
+            minutes = 0
+        if minutes <= 0:
+            return "Fail: minutes must be a positive whole number"
+        days = [day.lower()[:3] for day in days]
+        for day in days:
+            if day not in WEEKDAYS:
+                return "Fail: bad weekday: %s" % day
+
+        kind = command.target
+        if kind == "service":
+            kind = "host"
+        error = self._check_target(kind, target, services)
+        if error:
+            return error
+
+        definition = {"cmd": cmd, "target": target, "at": at,
+                      "minutes": minutes, "days": days,
+                      "services": list(services)}
+        try:
+            return self._maintenance.add(definition)
+        except (IOError, OSError):
+            return "Fail: could not save %s" % self.options.maintenance_file
+
+    def remove_maintenance(self, definition_id):
+        """
+        Unregister a recurring maintenance window by its id. Downtime
+        already scheduled for it is left alone.
+        """
+
+        try:
+            removed = self._maintenance.remove(str(definition_id))
+        except (IOError, OSError):
+            return "Fail: could not save %s" % self.options.maintenance_file
+        if not removed:
+            return "Fail: unknown maintenance window: %s" % definition_id
+        return True
+
+    def list_maintenance(self):
+        """
+        List the recurring maintenance windows, with the start of each
+        one's "next_window" and, once a window has been submitted,
+        "last_submitted" and "last_result".
+        """
 
+        return self._maintenance.list()
 
-class Nagios(func_module.FuncModule):
-    """
-    Perform common tasks in Nagios related to downtime and
-    notifications.
+    def schedule_host_tree_downtime(self, host, minutes=30, fixed=1,
+                                    trigger=0, verbose=None):
+        """
+        Schedule host downtime for a host and every host behind it,
+        following the `parents` relationships in objects.cache. Use it
+        when a switch, router or hypervisor goes into maintenance.
+
+        host - Root of the subtree
+        minutes - Length of the downtime
+        fixed - 1 for fixed downtime, 0 for flexible downtime that
+          starts when a host goes down
+        trigger - ID of an existing downtime (see get_downtimes) that
+          triggers the downtime of the hosts behind the root, or 0.
+          The root's own downtime is never triggered. To have Nagios
+          trigger the children's downtime from a new root downtime in
+          one call, use schedule_and_propagate_triggered_host_downtime
+          instead.
+        verbose - False to return a summary instead, see get_results
+
+        The commands are written as one batch per Nagios instance,
+        root first and every host after its parents. The tree is read
+        from the objects.cache of the instance monitoring the root.
+        Returns a result for each host, like schedule_downtime_bulk.
+        """
 
-    The complete set of external commands Nagios handles is documented
-    on their website:
+        root = self
+        if self._shards:
+            root = self._route_table().get(host, self)
+        if not root._objects.refresh():
+            return OBJECTS_FAIL
+        if host not in root._objects.host_services:
+            return "Fail: unknown host: %s" % host
 
-    http://old.nagios.org/developerinfo/externalcommands/commandlist.php
+        hosts = [host] + root._objects.descendants(host)
 
-    Note that in the case of `schedule_svc_downtime`,
-    `enable_svc_notifications`, and `disable_svc_notifications`, the
-    service argument should be passed as a list.
+        def run(instance, targets):
+            target_cmds = []
+            for name in hosts:
+                if name in targets:
+                    target_cmds.append((name, instance._fmt_dt_str(
+                        "SCHEDULE_HOST_DOWNTIME", name, minutes, fixed=fixed,
+                        trigger=name != host and trigger or 0)))
+            return instance._submit_bulk(target_cmds, {})
 
-    Configuration:
+        return self._report(None, self._per_instance(hosts, run), verbose)
 
-    If your nagios cmdfile is not /var/spool/nagios/cmd/nagios.cmd you
-    can configure this by creating a file called /etc/func/modules/Nagios.conf
-    that looks like this:
+    def list_instances(self):
+        """
+        List the Nagios instances this module writes to, starting with
+        "main". Each entry gives the instance's name, transport, the
+        path it writes to and how many hosts the bulk methods route to
+        it.
+        """
 
-        [main]
-        cmdfile = /path/to/your/nagios.cmd
+        routes = {}
+        if self._shards:
+            routes = self._route_table()
+        elif not self._objects.refresh():
+            return OBJECTS_FAIL
+
+        counts = {}
+        for instance in routes.values():
+            counts[instance._name] = counts.get(instance._name, 0) + 1
+        counts["main"] = len([host for host in self._objects.host_services
+                              if host not in routes])
+
+        return [{"name": instance._name,
+                 "transport": instance.options.transport,
+                 "path": instance._transport.path,
+                 "hosts": counts.get(instance._name, 0)}
+                for instance in [self] + self._shards]
+
+    def get_results(self, results_id, offset=0, limit=1000):
+        """
+        Fetch the full results of a call made with verbose off, a page
+        at a time. results_id comes from the call's summary. Only the
+        last 100 result sets are kept.
 
-    Examples:
+        Returns a dict with the "total" number of results, the
+        "offset" of this page and the page of "results".
+        """
 
-    import func.overlord.client as fc
-    nagios_server = fc.Client("nagios.mydomain.com")
+        results = self._results.get(results_id)
+        if results is None:
+            return "Fail: unknown or expired results id: %s" % results_id
+        return {"total": len(results),
+                "offset": offset,
+                "results": results[offset:offset + limit]}
 
-    # Schedule 1 hour of downtime for the http service on www01.
-    nagios_server.schedule_svc_downtime("www01.ext.mydomain.com",
-          ["http"], 60):
+    def pacing_status(self):
+        """
+        Report on the `rate_limit` pacing of the main instance.
+
+        Returns a dict with "enabled", the "backlog" of command lines
+        waiting for the rate limit, those lines by class in "waiting",
+        an estimate of the seconds until the backlog is written in
+        "wait", the seconds the oldest of them has waited in "age",
+        and the total seconds writers have spent waiting in "waited".
+        With pacing on it also gives the "rate", "burst" and current
+        "tokens".
+        """
 
-    # Schedule 30 minutes (default) of downtime for the rsync
-    # and nfs services on filer05.
-    nagios_server.schedule_svc_downtime("filer05.int.mydomain.com",
-          ["rsync", "nfs"]):
+        pacer = self._pacer
+        if pacer is None:
+            return {"enabled": False, "backlog": 0, "waiting": {},
+                    "wait": 0, "age": 0, "waited": 0}
+        return pacer.status()
 
-    # Schedule 30 minutes (default) of downtime the foobar host.
-    nagios_server.schedule_host_downtime("foobar.mydomain.com")
+    def _submit_check_results(self, entries, bulk_results):
+        """
+        Shared implementation of the submit_check_results methods.
+        entries is a list of (label, fields) tuples, where fields is
+        [host, service, return_code, output] or [host, status_code,
+        output] and label names the entry in failure messages. Results
+        are added to the bulk_results dict, which is returned.
+        """
 
-    # Reenable notifications for all services on the foobar host.
-    nagios_server.enable_host_svc_notifications("foobar.mydomain.com")
+        targets = {}
+        for label, fields in entries:
+            if not isinstance(fields, (list, tuple)):
+                fields = ()
+            if len(fields) == 4:
+                host, svc, code, output = fields
+            elif len(fields) == 3:
+                host, code, output = fields
+                svc = None
+            else:
+                bulk_results.setdefault(label, []).append(
+                    "Fail: expected host, [service,] code and output")
+                continue
+            if not isinstance(host, string_types) or \
+                    not isinstance(output, string_types) or \
+                    not (svc is None or isinstance(svc, string_types)):
+                bulk_results.setdefault(label, []).append(
+                    "Fail: host, service and output must be strings")
+                continue
+            targets.setdefault(host, []).append((svc, code, output))
+
+        results = self._per_instance(
+            targets, lambda instance, targets:
+            instance._check_results(targets))
+        for host, host_results in results.items():
+            bulk_results.setdefault(host, []).extend(host_results)
+        return bulk_results
+
+    def submit_check_results(self, results, verbose=None):
+        """
+        Submit passive check results in bulk, rather than one at a time
+        with send_nsca.
+
+        results is a list of [host, service, return_code, output] for
+        service check results and [host, status_code, output] for host
+        check results. Multi-line output is escaped so Nagios reads it
+        back as multiple lines.
+
+        Every command is written to the command file in one batch, or
+        with several Nagios instances configured, one batch per
+        instance. Returns a dict mapping each host to the list of
+        results for its commands, or a summary with verbose=False.
+        """
 
-    # Disable notifications for the foo and bar services on the
-    # megafrobber host.
-    nagios_server.disable_svc_notifications("megafrobber.mydomain.com",
-          ["foo", "bar"])
-    """
+        entries = [("result %d" % i, fields)
+                   for i, fields in enumerate(results)]
+        return self._report(None, self._submit_check_results(entries, {}),
+                            verbose)
 
-    version = "0.8.0"
-    api_version = "0.8.0"
-    description = "Schedule downtime and handle notifications in Nagios."
+    def submit_check_results_file(self, path):
+        """
+        Submit the passive check results in a file on the minion, in
+        send_nsca's input format: one result per line, with the host,
+        service (for service results), return code and output
+        separated by tabs. The file is read and submitted 10000 lines
+        at a time, and only failures are kept, so it can be
+        arbitrarily large.
+
+        Returns counts of each kind of result, as in the summary
+        submit_check_results returns with verbose=False, and
+        "failures", a dict mapping each host with failures, or "line N"
+        for a malformed line, to its failure messages.
+        """
 
-    class Config(BaseConfig):
-        cmdfile = Option("/var/spool/nagios/cmd/nagios.cmd")
+        try:
+            fp = open(path)
+        except IOError as e:
+            return "Fail: could not read %s: %s" % (path, e.strerror)
+
+        summary = {"commands": 0, "written": 0, "queued": 0, "spooled": 0,
+                   "skipped": 0, "failed": 0}
+        failures = {}
+
+        def submit(entries):
+            bulk_results = self._submit_check_results(entries, {})
+            counts = summarize_results(bulk_results)
+            for key in summary:
+                summary[key] += counts[key]
+            for target in counts["failed_targets"]:
+                failures.setdefault(target, []).extend(
+                    [result for result in bulk_results[target]
+                     if result.startswith("Fail:")])
 
-    def _now(self):
+        try:
+            entries = []
+            for number, line in enumerate(fp):
+                line = line.rstrip("\r\n")
+                if not line:
+                    continue
+                entries.append(("line %d" % (number + 1), line.split("\t")))
+                if len(entries) == CHECK_RESULT_BATCH:
+                    submit(entries)
+                    entries = []
+            if entries:
+                submit(entries)
+        finally:
+            fp.close()
+
+        summary["failures"] = failures
+        return summary
+
+    def confirm(self, method, *args):
         """
-        The time in seconds since 12:00:00AM Jan 1, 1970
+        Call another method of this module, then wait until Nagios has
+        logged every command it sent, or `confirm_timeout` seconds
+        pass.
+
+        For example, to schedule downtime and know it was applied:
+
+            confirm("schedule_host_downtime", "www01", 60)
+
+        Returns a dict with the method's own return value as "result",
+        the number of "confirmed" commands, the commands that weren't
+        logged in time as "unconfirmed", and "latencies", a list of
+        [command, seconds] pairs saying how long after the call began
+        each confirmed command was logged.
         """
 
-        return int(time.time())
+        if method[0] == "_" or method == "confirm" or \
+                not hasattr(self, method):
+            return "Fail: no such method: %s" % method
+        if self._log_watcher is None:
+            try:
+                self._log_watcher = LogWatcher(self.options.log_file)
+            except (IOError, OSError):
+                return "Fail: could not read %s" % self.options.log_file
+
+        since = time.time()
+        result = getattr(self, method)(*args)
+
+        # Pick the commands that were sent (or queued or spooled) out
+        # of the results, or out of the stored results of a summary.
+        # Dicts that aren't results by target, like counts or stats,
+        # only have their lists looked at.
+        if isinstance(result, dict) and "results_id" in result:
+            results = self._results.get(result["results_id"]) or []
+        elif isinstance(result, dict):
+            results = [r for target in sorted(result)
+                       if isinstance(result[target], list)
+                       for r in result[target]]
+        elif isinstance(result, list):
+            results = result
+        else:
+            results = [result]
+        commands = [r[r.index("["):] for r in results
+                    if isinstance(r, string_types) and "[" in r and
+                    not r.startswith("Fail:") and
+                    not r.startswith("Skipped:")]
+
+        latencies = self._log_watcher.wait(commands, since,
+                                           self.options.confirm_timeout)
+        confirmed = [[cmd, latency] for cmd, latency
+                     in zip(commands, latencies) if latency != -1]
+        return {"result": result,
+                "confirmed": len(confirmed),
+                "unconfirmed": [cmd for cmd, latency
+                                in zip(commands, latencies) if latency == -1],
+                "latencies": confirmed}
+
+    def get_state_changes(self, since_token=""):
+        """
+        Report what changed in Nagios' downtime, notification and
+        acknowledgement state since an earlier call, according to
+        status.dat, so the state can be mirrored without fetching all
+        of it every time.
+
+        Pass the token from the previous call's result, or nothing the
+        first time. Returns a dict with a new "token", the list of
+        "changes" (see `diff_status` in the module for their format),
+        and "reset", which is True when the token was missing, unknown
+        or too old. The changes then describe the whole current state
+        and the client should start its copy over.
+        """
 
-    def _write_command(self, cmd):
+        if not self._status.refresh():
+            return STATUS_FAIL
+        self._state_feed.update(self._status)
+        changes, reset = self._state_feed.changes_since(since_token)
+        return {"token": self._state_feed.token(),
+                "reset": reset,
+                "changes": changes}
+
+    def _snapshot_path(self, snapshot_id):
         """
-        Write the given command to the Nagios command file
+        Path of a snapshot's file, or None if snapshot_id can't be the
+        id of a snapshot
+        """
+
+        try:
+            snapshot_id = int(snapshot_id)
+        except (TypeError, ValueError):
+            return None
+        return os.path.join(self.options.snapshot_dir,
+                            "%d.json" % snapshot_id)
+
+    def _snapshot_ids(self):
+        """
+        The ids of the saved snapshots, oldest first
+        """
+
+        try:
+            names = os.listdir(self.options.snapshot_dir)
+        except OSError:
+            return []
+        return sorted([int(name[:-5]) for name in names
+                       if name.endswith(".json") and name[:-5].isdigit()])
+
+    def _read_snapshot(self, snapshot_id):
+        """
+        Load a saved snapshot, or return None if there is no such
+        snapshot
+        """
+
+        path = self._snapshot_path(snapshot_id)
+        if path is None:
+            return None
+        try:
+            fp = open(path)
+            try:
+                return json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return None
+
+    def _write_file(self, path, data):
+        """
+        Replace a file's contents with data, so that a crash leaves
+        either the old or the new contents
         """
 
+        tmp_path = path + ".tmp"
+        fp = open(tmp_path, "w")
         try:
-            fp = open(self.options.cmdfile, 'w')
-            fp.write(cmd)
+            fp.write(data)
             fp.flush()
+            os.fsync(fp.fileno())
+        finally:
             fp.close()
-            return True
-        except IOError:
-            return False
+        os.rename(tmp_path, path)
 
-    def _fmt_dt_str(self, cmd, host, duration, author="func",
-                    comment="Scheduling downtime", start=None,
-                    svc=None, fixed=1, trigger=0):
+    def snapshot_notification_state(self, targets):
+        """
+        Save the current notification flags of some hosts and their
+        services, so they can be put back with
+        restore_notification_state after maintenance.
+
+        targets is either a list of host names, to save the flags of
+        each host and all of its services, or a dict mapping host
+        names to lists of services, where a host mapped to an empty
+        list means the host and all of its services. Services may be
+        patterns, as for disable_svc_notifications.
+
+        The flags come from the status.dat of the Nagios instance
+        monitoring each host, along with any notification commands
+        sent since it was written. Each snapshot is saved to its own
+        file in `snapshot_dir`, so taking or restoring one doesn't get
+        slower as snapshots pile up. Returns the snapshot's id.
         """
-        Format an external-command downtime string.
 
-        cmd - Nagios command ID
-        host - Host schedule downtime on
-        duration - Minutes to schedule downtime for
-        author - Name to file the downtime as
-        comment - Reason for running this command (upgrade, reboot, etc)
-        start - Start of downtime in seconds since 12:00AM Jan 1 1970
-          Default is to use the entry time (now)
-        svc - Service to schedule downtime for, omit when for host downtime
-        fixed - Start now if 1, start when a problem is detected if 0
-        trigger - Optional ID of event to start downtime from. Leave as 0 for
-          fixed downtime.
+        if not self._shards and not self._status.refresh():
+            return STATUS_FAIL
+
+        states = self._per_instance(
+            targets, lambda instance, targets:
+            instance._notif_states(targets), True)
+
+        enabled = []
+        disabled = []
+        for host in sorted(states):
+            for state in states[host]:
+                if not isinstance(state, list):
+                    # A failure message
+                    return state
+                # Snapshot entries are [host, service], "" for a host
+                if state[1]:
+                    enabled.append([host, state[0]])
+                else:
+                    disabled.append([host, state[0]])
+
+        snapshot_dir = self.options.snapshot_dir
+        next_id_path = os.path.join(snapshot_dir, "next_id")
+        self._snapshot_lock.acquire()
+        try:
+            try:
+                if not os.path.isdir(snapshot_dir):
+                    os.makedirs(snapshot_dir)
+                # Ids aren't reused after the newest snapshot is
+                # deleted, so an old id never names a different one
+                snapshot_id = 1
+                try:
+                    fp = open(next_id_path)
+                    try:
+                        snapshot_id = int(fp.read())
+                    finally:
+                        fp.close()
+                except (IOError, ValueError):
+                    pass
+                ids = self._snapshot_ids()
+                if ids:
+                    snapshot_id = max(snapshot_id, ids[-1] + 1)
+
+                self._write_file(
+                    self._snapshot_path(snapshot_id),
+                    json.dumps({"id": snapshot_id,
+                                "time": int(time.time()),
+                                "enabled": enabled,
+                                "disabled": disabled},
+                               separators=(",", ":")))
+                self._write_file(next_id_path, "%d\n" % (snapshot_id + 1))
+            except (IOError, OSError):
+                return "Fail: could not save a snapshot in %s" % snapshot_dir
+        finally:
+            self._snapshot_lock.release()
+
+        return snapshot_id
+
+    def _notif_states(self, targets):
+        """
+        Look up the notification flags for snapshot_notification_state
+        on one instance. Returns a dict mapping each host to a list of
+        [service, enabled] pairs, where the service is "" for the host
+        itself, or to a list holding a failure message.
+        """
 
-        Syntax: [submitted] COMMAND;<host_name>;[<service_description>]
-        <start_time>;<end_time>;<fixed>;<trigger_id>;<duration>;<author>;
-        <comment>
+        if not self._status.refresh():
+            return dict([(host, [STATUS_FAIL])
+                         for host, services in self._bulk_targets(targets)])
+
+        states = {}
+        for host, services in self._bulk_targets(targets):
+            if services:
+                services, error = self._expand_services(host, services)
+                if error:
+                    states[host] = [error]
+                    continue
+                objects = [(host, svc) for svc in services]
+            else:
+                if host not in self._status.hosts:
+                    states[host] = ["Fail: unknown host: %s" % host]
+                    continue
+                objects = [(host, None)] + [
+                    (host, svc) for svc in
+                    self._status.host_services.get(host, [])]
+            host_states = []
+            for obj in objects:
+                state = self._notif_enabled(obj)
+                if state is None:
+                    host_states = ["Fail: unknown service(s) on %s: %s" % obj]
+                    break
+                host_states.append([obj[1] or "", state])
+            states[host] = host_states
+        return states
+
+    def list_notification_snapshots(self):
+        """
+        List the saved notification snapshots, oldest first. Each
+        entry gives the snapshot's id and the time it was taken.
         """
 
-        entry_time = self._now()
-        if start is None:
-            start = entry_time
+        snapshots = []
+        for snapshot_id in self._snapshot_ids():
+            try:
+                taken = os.stat(self._snapshot_path(snapshot_id)).st_mtime
+            except OSError:
+                continue
+            snapshots.append({"id": snapshot_id, "time": int(taken)})
+        return snapshots
 
-        hdr = "[%s] %s;%s;" % (entry_time, cmd, host)
-        duration_s = (duration * 60)
-        end = start + duration_s
+    def delete_notification_snapshot(self, snapshot_id):
+        """
+        Delete a saved notification snapshot once it is no longer
+        needed.
+        """
 
-        if svc is not None:
-            dt_args = [svc, str(start), str(end), str(fixed), str(trigger),
-                       str(duration_s), author, comment]
-        else:
-            # Downtime for a host if no svc specified
-            dt_args = [str(start), str(end), str(fixed), str(trigger),
-                       str(duration_s), author, comment]
+        path = self._snapshot_path(snapshot_id)
+        if path is None:
+            return "Fail: unknown snapshot: %s" % snapshot_id
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return "Fail: unknown snapshot: %s" % snapshot_id
+            return "Fail: could not delete %s: %s" % (path, e)
+        return True
+
+    def restore_notification_state(self, snapshot_id, verbose=None):
+        """
+        Put the notification flags saved by snapshot_notification_state
+        back. Only the hosts and services whose flags differ from the
+        snapshot are sent a command, all in one batch, or with several
+        Nagios instances configured, one batch per instance. Hosts and
+        services that no longer exist are left out.
+
+        Returns a dict mapping each host to the list of results for
+        its commands, which is empty if nothing changed, or a summary
+        with verbose=False.
+        """
 
-        dt_arg_str = ";".join(dt_args)
-        dt_str = hdr + dt_arg_str + "\n"
+        if not self._shards and not self._status.refresh():
+            return STATUS_FAIL
 
-        return dt_str
+        snapshot = self._read_snapshot(snapshot_id)
+        if snapshot is None:
+            return "Fail: unknown snapshot: %s" % snapshot_id
 
-    def _fmt_notif_str(self, cmd, host, svc=None):
-        """
-        Format an external-command notification string.
+        # host -> [(service, enabled), ...], service None for a host
+        targets = {}
+        for entries, state in ((snapshot["enabled"], True),
+                               (snapshot["disabled"], False)):
+            for host, svc in entries:
+                targets.setdefault(host, []).append((svc or None, state))
 
-        cmd - Nagios command ID.
-        host - Host to en/disable notifications on..
-        svc - Service to schedule downtime for. A value is not required
-          for host downtime.
+        return self._report(None, self._per_instance(
+            targets, lambda instance, targets:
+            instance._restore_notifs(targets), True), verbose)
 
-        Syntax: [submitted] COMMAND;<host_name>[;<service_description>]
+    def _restore_notifs(self, targets):
+        """
+        Implementation of restore_notification_state for one instance.
+        targets maps host names to lists of (service, enabled) flags
+        saved in the snapshot.
         """
 
-        entry_time = self._now()
-        if svc is not None:
-            notif_str = "[%s] %s;%s;%s\n" % (entry_time, cmd, host, svc)
-        else:
-            # Downtime for a host if no svc specified
-            notif_str = "[%s] %s;%s\n" % (entry_time, cmd, host)
-
-        return notif_str
+        if not self._status.refresh():
+            return dict([(host, [STATUS_FAIL]) for host in targets])
+
+        saved_enabled = set()
+        saved_disabled = set()
+        for host, flags in targets.items():
+            for svc, state in flags:
+                if state:
+                    saved_enabled.add((host, svc))
+                else:
+                    saved_disabled.add((host, svc))
+
+        enabled = set()
+        disabled = set()
+        for obj in saved_enabled | saved_disabled:
+            state = self._notif_enabled(obj)
+            if state is True:
+                enabled.add(obj)
+            elif state is False:
+                disabled.add(obj)
+
+        # Objects whose current state is unknown are in neither set,
+        # so they drop out here
+        notifs = []
+        for action, objs in (("ENABLE", saved_enabled & disabled),
+                             ("DISABLE", saved_disabled & enabled)):
+            for host, svc in sorted(objs, key=lambda obj: (obj[0],
+                                                           obj[1] or "")):
+                if svc is None:
+                    notifs.append(("%s_HOST_NOTIFICATIONS" % action,
+                                   host, None))
+                else:
+                    notifs.append(("%s_SVC_NOTIFICATIONS" % action,
+                                   host, svc))
+
+        bulk_results = {}
+        for (cmd, host, svc), result in zip(notifs,
+                                            self._submit_notif(notifs)):
+            bulk_results.setdefault(host, []).append(result)
+        return bulk_results
+
+    def batch(self, operations):
+        """
+        Call several methods of this module in one request, in order.
+        operations is a list of [method, arg, ...] lists. Returns a
+        list with the result of each call. A call that raises gets a
+        "Fail:" result and the rest still run.
 
-    def schedule_svc_downtime(self, host, services=[], minutes=30):
+        This saves a round trip per call when one overlord drives many
+        operations, see nagios_client.py.
         """
+
+        results = []
+        for operation in operations:
+            method = operation and operation[0] or ""
+            if not method or method[0] == "_" or \
+                    method in ("batch", "register_rpc") or \
+                    not hasattr(self, method):
+                results.append("Fail: no such method: %s" % method)
+                continue
+            try:
+                results.append(getattr(self, method)(*operation[1:]))
+            except Exception as e:
+                results.append("Fail: %s: %s" % (method, e))
+        return results
+
+
+# The downtime and notification methods are generated from the command
+# registry: (method name, docstring). The method name is the command
+# name in lower case.
+
+DOWNTIME_METHODS = [
+    ("schedule_svc_downtime", """
         This command is used to schedule downtime for a particular
         service.
 
@@ -166,23 +4068,8 @@ class Nagios(func_module.FuncModule):
         Syntax: SCHEDULE_SVC_DOWNTIME;<host_name>;<service_description>
         <start_time>;<end_time>;<fixed>;<trigger_id>;<duration>;<author>;
         <comment>
-        """
-
-        cmd = "SCHEDULE_SVC_DOWNTIME"
-        nagios_return = True
-        return_str_list = []
-        for service in services:
-            dt_cmd_str = self._fmt_dt_str(cmd, host, minutes, svc=service)
-            nagios_return = nagios_return and self._write_command(dt_cmd_str)
-            return_str_list.append(dt_cmd_str)
-
-        if nagios_return:
-            return return_str_list
-        else:
-            return "Fail: could not write to the command file"
-
-    def schedule_host_downtime(self, host, minutes=30):
-        """
+        """),
+    ("schedule_host_downtime", """
         This command is used to schedule downtime for a particular
         host.
 
@@ -191,19 +4078,8 @@ class Nagios(func_module.FuncModule):
 
         Syntax: SCHEDULE_HOST_DOWNTIME;<host_name>;<start_time>;<end_time>;
         <fixed>;<trigger_id>;<duration>;<author>;<comment>
-        """
-
-        cmd = "SCHEDULE_HOST_DOWNTIME"
-        dt_cmd_str = self._fmt_dt_str(cmd, host, minutes)
-        nagios_return = self._write_command(dt_cmd_str)
-
-        if nagios_return:
-            return dt_cmd_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def schedule_hostgroup_host_downtime(self, hostgroup, minutes=30):
-        """
+        """),
+    ("schedule_hostgroup_host_downtime", """
         This command is used to schedule downtime for all hosts in a
         particular hostgroup.
 
@@ -212,19 +4088,8 @@ class Nagios(func_module.FuncModule):
 
         Syntax: SCHEDULE_HOSTGROUP_HOST_DOWNTIME;<hostgroup_name>;<start_time>;
         <end_time>;<fixed>;<trigger_id>;<duration>;<author>;<comment>
-        """
-
-        cmd = "SCHEDULE_HOSTGROUP_HOST_DOWNTIME"
-        dt_cmd_str = self._fmt_dt_str(cmd, hostgroup, minutes)
-        nagios_return = self._write_command(dt_cmd_str)
-
-        if nagios_return:
-            return dt_cmd_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def schedule_hostgroup_svc_downtime(self, hostgroup, minutes=30):
-        """
+        """),
+    ("schedule_hostgroup_svc_downtime", """
         This command is used to schedule downtime for all services in
         a particular hostgroup.
 
@@ -237,19 +4102,8 @@ class Nagios(func_module.FuncModule):
 
         Syntax: SCHEDULE_HOSTGROUP_SVC_DOWNTIME;<hostgroup_name>;<start_time>;
         <end_time>;<fixed>;<trigger_id>;<duration>;<author>;<comment>
-        """
-
-        cmd = "SCHEDULE_HOSTGROUP_SVC_DOWNTIME"
-        dt_cmd_str = self._fmt_dt_str(cmd, hostgroup, minutes)
-        nagios_return = self._write_command(dt_cmd_str)
-
-        if nagios_return:
-            return dt_cmd_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def schedule_servicegroup_host_downtime(self, servicegroup, minutes=30):
-        """
+        """),
+    ("schedule_servicegroup_host_downtime", """
         This command is used to schedule downtime for all hosts in a
         particular servicegroup.
 
@@ -259,19 +4113,8 @@ class Nagios(func_module.FuncModule):
         Syntax: SCHEDULE_SERVICEGROUP_HOST_DOWNTIME;<servicegroup_name>;
         <start_time>;<end_time>;<fixed>;<trigger_id>;<duration>;<author>;
         <comment>
-        """
-
-        cmd = "SCHEDULE_SERVICEGROUP_HOST_DOWNTIME"
-        dt_cmd_str = self._fmt_dt_str(cmd, servicegroup, minutes)
-        nagios_return = self._write_command(dt_cmd_str)
-
-        if nagios_return:
-            return dt_cmd_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def schedule_servicegroup_svc_downtime(self, servicegroup, minutes=30):
-        """
+        """),
+    ("schedule_servicegroup_svc_downtime", """
         This command is used to schedule downtime for all services in
         a particular servicegroup.
 
@@ -285,19 +4128,11 @@ class Nagios(func_module.FuncModule):
         Syntax: SCHEDULE_SERVICEGROUP_SVC_DOWNTIME;<servicegroup_name>;
         <start_time>;<end_time>;<fixed>;<trigger_id>;<duration>;<author>;
         <comment>
-        """
-
-        cmd = "SCHEDULE_SERVICEGROUP_SVC_DOWNTIME"
-        dt_cmd_str = self._fmt_dt_str(cmd, servicegroup, minutes)
-        nagios_return = self._write_command(dt_cmd_str)
-
-        if nagios_return:
-            return dt_cmd_str
-        else:
-            return "Fail: could not write to the command file"
+        """),
+]
 
-    def disable_host_svc_notifications(self, host):
-        """
+NOTIFICATION_METHODS = [
+    ("disable_host_svc_notifications", """
         This command is used to prevent notifications from being sent
         out for all services on the specified host.
 
@@ -305,19 +4140,8 @@ class Nagios(func_module.FuncModule):
         being sent out about the host.
 
         Syntax: DISABLE_HOST_SVC_NOTIFICATIONS;<host_name>
-        """
-
-        cmd = "DISABLE_HOST_SVC_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, host)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def disable_host_notifications(self, host):
-        """
+        """),
+    ("disable_host_notifications", """
         This command is used to prevent notifications from being sent
         out for the specified host.
 
@@ -325,19 +4149,8 @@ class Nagios(func_module.FuncModule):
         services associated with this host.
 
         Syntax: DISABLE_HOST_NOTIFICATIONS;<host_name>
-        """
-
-        cmd = "DISABLE_HOST_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, host)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def disable_svc_notifications(self, host, services=[]):
-        """
+        """),
+    ("disable_svc_notifications", """
         This command is used to prevent notifications from being sent
         out for the specified service.
 
@@ -345,23 +4158,8 @@ class Nagios(func_module.FuncModule):
         being sent out about the host.
 
         Syntax: DISABLE_SVC_NOTIFICATIONS;<host_name>;<service_description>
-        """
-
-        cmd = "DISABLE_SVC_NOTIFICATIONS"
-        nagios_return = True
-        return_str_list = []
-        for service in services:
-            notif_str = self._fmt_notif_str(cmd, host, svc=service)
-            nagios_return = nagios_return and self._write_command(notif_str)
-            return_str_list.append(notif_str)
-
-        if nagios_return:
-            return return_str_list
-        else:
-            return "Fail: could not write to the command file"
-
-    def disable_servicegroup_host_notifications(self, servicegroup):
-        """
+        """),
+    ("disable_servicegroup_host_notifications", """
         This command is used to prevent notifications from being sent
         out for all hosts in the specified servicegroup.
 
@@ -369,19 +4167,8 @@ class Nagios(func_module.FuncModule):
         services associated with hosts in this service group.
 
         Syntax: DISABLE_SERVICEGROUP_HOST_NOTIFICATIONS;<servicegroup_name>
-        """
-
-        cmd = "DISABLE_SERVICEGROUP_HOST_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, servicegroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def disable_servicegroup_svc_notifications(self, servicegroup):
-        """
+        """),
+    ("disable_servicegroup_svc_notifications", """
         This command is used to prevent notifications from being sent
         out for all services in the specified servicegroup.
 
@@ -389,19 +4176,8 @@ class Nagios(func_module.FuncModule):
         out about the hosts in this servicegroup.
 
         Syntax: DISABLE_SERVICEGROUP_SVC_NOTIFICATIONS;<servicegroup_name>
-        """
-
-        cmd = "DISABLE_SERVICEGROUP_SVC_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, servicegroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def disable_hostgroup_host_notifications(self, hostgroup):
-        """
+        """),
+    ("disable_hostgroup_host_notifications", """
         Disables notifications for all hosts in a particular
         hostgroup.
 
@@ -410,19 +4186,8 @@ class Nagios(func_module.FuncModule):
         DISABLE_HOSTGROUP_SVC_NOTIFICATIONS command for that.
 
         Syntax: DISABLE_HOSTGROUP_HOST_NOTIFICATIONS;<hostgroup_name>
-        """
-
-        cmd = "DISABLE_HOSTGROUP_HOST_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, hostgroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def disable_hostgroup_svc_notifications(self, hostgroup):
-        """
+        """),
+    ("disable_hostgroup_svc_notifications", """
         Disables notifications for all services associated with hosts
         in a particular hostgroup.
 
@@ -431,97 +4196,38 @@ class Nagios(func_module.FuncModule):
         command for that.
 
         Syntax: DISABLE_HOSTGROUP_SVC_NOTIFICATIONS;<hostgroup_name>
-        """
-
-        cmd = "DISABLE_HOSTGROUP_SVC_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, hostgroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_host_notifications(self, host):
-        """
+        """),
+    ("enable_host_notifications", """
         Enables notifications for a particular host.
 
         Note that this command does not enable notifications for
         services associated with this host.
 
         Syntax: ENABLE_HOST_NOTIFICATIONS;<host_name>
-        """
-
-        cmd = "ENABLE_HOST_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, host)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_host_svc_notifications(self, host):
-        """
+        """),
+    ("enable_host_svc_notifications", """
         Enables notifications for all services on the specified host.
 
         Note that this does not enable notifications for the host.
 
         Syntax: ENABLE_HOST_SVC_NOTIFICATIONS;<host_name>
-        """
-
-        cmd = "ENABLE_HOST_SVC_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, host)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_svc_notifications(self, host, services=[]):
-        """
+        """),
+    ("enable_svc_notifications", """
         Enables notifications for a particular service.
 
         Note that this does not enable notifications for the host.
 
         Syntax: ENABLE_SVC_NOTIFICATIONS;<host_name>;<service_description>
-        """
-
-        cmd = "ENABLE_SVC_NOTIFICATIONS"
-        nagios_return = True
-        return_str_list = []
-        for service in services:
-            notif_str = self._fmt_notif_str(cmd, host, svc=service)
-            nagios_return = nagios_return and self._write_command(notif_str)
-            return_str_list.append(notif_str)
-
-        if nagios_return:
-            return return_str_list
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_hostgroup_host_notifications(self, hostgroup):
-        """
+        """),
+    ("enable_hostgroup_host_notifications", """
         Enables notifications for all hosts in a particular hostgroup.
 
         Note that this command does not enable notifications for
         services associated with the hosts in this hostgroup.
 
         Syntax: ENABLE_HOSTGROUP_HOST_NOTIFICATIONS;<hostgroup_name>
-        """
-
-        cmd = "ENABLE_HOSTGROUP_HOST_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, hostgroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_hostgroup_svc_notifications(self, hostgroup):
-        """
+        """),
+    ("enable_hostgroup_svc_notifications", """
         Enables notifications for all services that are associated
         with hosts in a particular hostgroup.
 
@@ -529,19 +4235,8 @@ class Nagios(func_module.FuncModule):
         this hostgroup.
 
         Syntax: ENABLE_HOSTGROUP_SVC_NOTIFICATIONS;<hostgroup_name>
-        """
-
-        cmd = "ENABLE_HOSTGROUP_SVC_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, hostgroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_servicegroup_host_notifications(self, servicegroup):
-        """
+        """),
+    ("enable_servicegroup_host_notifications", """
         Enables notifications for all hosts that have services that
         are members of a particular servicegroup.
 
@@ -549,19 +4244,8 @@ class Nagios(func_module.FuncModule):
         services associated with the hosts in this servicegroup.
 
         Syntax: ENABLE_SERVICEGROUP_HOST_NOTIFICATIONS;<servicegroup_name>
-        """
-
-        cmd = "ENABLE_SERVICEGROUP_HOST_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, servicegroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
-
-    def enable_servicegroup_svc_notifications(self, servicegroup):
-        """
+        """),
+    ("enable_servicegroup_svc_notifications", """
         Enables notifications for all services that are members of a
         particular servicegroup.
 
@@ -569,13 +4253,73 @@ class Nagios(func_module.FuncModule):
         this servicegroup.
 
         Syntax: ENABLE_SERVICEGROUP_SVC_NOTIFICATIONS;<servicegroup_name>
-        """
-
-        cmd = "ENABLE_SERVICEGROUP_SVC_NOTIFICATIONS"
-        notif_str = self._fmt_notif_str(cmd, servicegroup)
-        nagios_return = self._write_command(notif_str)
-
-        if nagios_return:
-            return notif_str
-        else:
-            return "Fail: could not write to the command file"
+        """),
+]
+
+
+# The generated methods keep the parameter names of the hand written
+# methods they replaced: host, hostgroup or servicegroup
+def _downtime_method(cmd, doc):
+    kind = COMMANDS[cmd].target
+    if kind == "service":
+        def method(self, host, services=[], minutes=30, verbose=None):
+            return self._report(
+                host, self._schedule_downtime(cmd, host, services, minutes),
+                verbose)
+    elif kind == "host":
+        def method(self, host, minutes=30):
+            return self._schedule_downtime(cmd, host, None, minutes)
+    elif kind == "hostgroup":
+        def method(self, hostgroup, minutes=30):
+            return self._schedule_downtime(cmd, hostgroup, None, minutes)
+    else:
+        def method(self, servicegroup, minutes=30):
+            return self._schedule_downtime(cmd, servicegroup, None, minutes)
+    method.__name__ = cmd.lower()
+    method.__doc__ = doc
+    return method
+
+
+def _notification_method(cmd, doc):
+    kind = COMMANDS[cmd].target
+    if kind == "service":
+        def method(self, host, services=[], verbose=None):
+            return self._report(
+                host, self._set_notifications(cmd, host, services), verbose)
+    elif kind == "host":
+        def method(self, host):
+            return self._set_notifications(cmd, host, None)
+    elif kind == "hostgroup":
+        def method(self, hostgroup):
+            return self._set_notifications(cmd, hostgroup, None)
+    else:
+        def method(self, servicegroup):
+            return self._set_notifications(cmd, servicegroup, None)
+    method.__name__ = cmd.lower()
+    method.__doc__ = doc
+    return method
+
+
+def _command_method(cmd):
+    def method(self, *args):
+        return self._send_command(cmd, args)
+    method.__name__ = cmd.lower()
+    method.__doc__ = """
+        Send the %s external command, see `send_command`.
+
+        Syntax: %s
+        """ % (cmd, COMMANDS[cmd].syntax)
+    return method
+
+
+for _name, _doc in DOWNTIME_METHODS:
+    setattr(Nagios, _name, _downtime_method(_name.upper(), _doc))
+
+for _name, _doc in NOTIFICATION_METHODS:
+    setattr(Nagios, _name, _notification_method(_name.upper(), _doc))
+
+# Every other command in the registry gets a method taking the
+# command's raw arguments
+for _cmd in COMMANDS:
+    if not hasattr(Nagios, _cmd.lower()):
+        setattr(Nagios, _cmd.lower(), _command_method(_cmd))
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 # Some basic tests against the func-nagios module.
+#
+# These need a real Nagios. To exercise the module offline, including
+# under load and with Nagios restarting or falling behind, use
+# nagios_sim.py instead.
 
 import func.overlord.client as fc
 
@@ -9,6 +13,33 @@ if __name__ == '__main__':
 
     # For testing it's best to roll through these in groups.
 
+    ##############################################
+    # OBJECT LOOKUP TESTS
+    ##############################################
+
+    # These read Nagios' objects.cache and don't change anything, so
+    # they can be ran at any time.
+
+    # print n.nagios.get_host_services('redstonefoundries.com')
+    # print n.nagios.get_hostgroup_members('ext-servers')
+    # print n.nagios.get_servicegroup_members('httpservers')
+
+    # These read Nagios' status.dat and also don't change anything.
+
+    # print n.nagios.get_downtimes()
+    # print n.nagios.get_downtimes('redstonefoundries.com', 'HTTP')
+    # print n.nagios.get_notification_state('redstonefoundries.com')
+    # print n.nagios.get_notification_state('redstonefoundries.com', ['HTTP'])
+
+    # Mirror state changes: the first call lists everything, later
+    # calls with the returned token only what changed since.
+    # print n.nagios.get_state_changes()
+    # print n.nagios.get_state_changes('1307000000:1')
+
+    # A misspelled service is refused instead of silently ignored by
+    # Nagios.
+    # print n.nagios.schedule_svc_downtime('lnx.cx', ['HTPP'], 2)
+
     ##############################################
     # DOWNTIME SCHEDULING TESTS
     ##############################################
@@ -22,6 +53,20 @@ if __name__ == '__main__':
     # print n.nagios.schedule_svc_downtime('redstonefoundries.com', ['HTTP','Minecraft'], 2)
     # print n.nagios.schedule_host_downtime('tbielawa.com', 2)
 
+    # Services can be picked by pattern: a glob after "glob:", or a
+    # regular expression after "re:".
+    # print n.nagios.schedule_svc_downtime('lnx.cx', ['glob:BIP*'], 2)
+    # print n.nagios.disable_svc_notifications('lnx.cx', ['re:^(HTTP|BIP)'])
+
+    # A summary instead of every command sent, then the full results
+    # a page at a time using the results_id from the summary.
+    # print n.nagios.schedule_svc_downtime('lnx.cx', ['glob:*'], 2, False)
+    # print n.nagios.get_results(1, 0, 100)
+
+    # Schedule downtime and wait until Nagios has logged processing
+    # it. Needs log_external_commands=1 in nagios.cfg.
+    # print n.nagios.confirm('schedule_svc_downtime', 'lnx.cx', ['HTTP'], 2)
+
     ##############################################
     # These next two commands also test downtime scheduling, but do so
     # to groups of servers. These can be ran together because one will
@@ -41,6 +86,72 @@ if __name__ == '__main__':
     # print n.nagios.schedule_servicegroup_host_downtime('ircservers', 2)
     # print n.nagios.schedule_servicegroup_svc_downtime('httpservers', 2)
 
+    ##############################################
+    # Bulk downtime scheduling. The first command sets host downtime
+    # on two hosts, the second mixes host downtime with service
+    # downtime. Every command in a call goes out in one batch.
+
+    # print n.nagios.schedule_downtime_bulk(['lnx.cx', 'tbielawa.com'], 2)
+    # print n.nagios.schedule_downtime_bulk({'lnx.cx': ['HTTP'], 'tbielawa.com': []}, 2)
+
+    ##############################################
+    # Downtime for a host and every host behind it, following the
+    # parents set in the Nagios configuration. The second call
+    # schedules fixed downtime for core-switch, and flexible downtime
+    # triggered by downtime ID 42 for the hosts behind it.
+
+    # print n.nagios.schedule_host_tree_downtime('core-switch', 2)
+    # print n.nagios.schedule_host_tree_downtime('core-switch', 2, 0, 42)
+
+    ##############################################
+    # With 'queue = True' in Nagios.conf the calls above return as
+    # soon as their commands are queued. Pass the ticket number from
+    # a result to queue_status to see if they've been written yet.
+
+    # print n.nagios.queue_status(1)
+
+    # With 'spool = True', commands that can't be written (stop
+    # Nagios to try it) are saved and retried later. This shows how
+    # many are waiting and for how long.
+
+    # print n.nagios.spool_status()
+
+    # With 'rate_limit' set, see how many command lines are waiting to
+    # be written and roughly how long they will take.
+
+    # print n.nagios.pacing_status()
+
+    # With 'stats = True', every call is counted and timed. Run some
+    # of the tests above, then look at the numbers and reset them.
+
+    # print n.nagios.stats()
+    # print n.nagios.reset_stats()
+
+    # With [instance:NAME] sections in Nagios.conf, see which instance
+    # each host's bulk commands will go to.
+
+    # print n.nagios.list_instances()
+
+    ##############################################
+    # Cancel the downtime scheduled by the tests above. The first
+    # cancels everything on one host, the second everything this
+    # module scheduled, the third anything whose comment matches.
+
+    # print n.nagios.cancel_downtime('lnx.cx')
+    # print n.nagios.cancel_downtime('', [], 'func')
+    # print n.nagios.cancel_downtime('', [], '', '^Scheduling')
+
+    ##############################################
+    # Recurring maintenance: 90 minutes of downtime for the
+    # linux-servers hostgroup every Sunday at 02:00, and the HTTP
+    # service on lnx.cx every night at 03:30. The minion schedules
+    # each window itself shortly before it starts.
+
+    # print n.nagios.add_maintenance('SCHEDULE_HOSTGROUP_HOST_DOWNTIME', 'linux-servers', '02:00', 90, ['sun'])
+    # print n.nagios.add_maintenance('SCHEDULE_SVC_DOWNTIME', 'lnx.cx', '03:30', 15, [], ['HTTP'])
+    # print n.nagios.list_maintenance()
+    # print n.nagios.remove_maintenance('1')
+
     ##############################################
     # NOTIFICATION TOGGLING TESTS
     ##############################################
@@ -99,3 +210,54 @@ if __name__ == '__main__':
     # print n.nagios.disable_hostgroup_svc_notifications('linux-servers')
     # Reenable ALL service notifications for every member host
     # print n.nagios.enable_hostgroup_svc_notifications('linux-servers')
+
+    ##############################################
+    # Disable notifications in bulk: host notifications for
+    # peopleareducks.com and the HTTP and Minecraft service
+    # notifications on redstonefoundries.com
+    # print n.nagios.disable_notifications_bulk({'peopleareducks.com': [], 'redstonefoundries.com': ['HTTP', 'Minecraft']})
+    # Reenable them all again
+    # print n.nagios.enable_notifications_bulk({'peopleareducks.com': [], 'redstonefoundries.com': ['HTTP', 'Minecraft']})
+
+    ##############################################
+    # Save the notification flags of redstonefoundries.com and its
+    # services, mute everything for maintenance, then put back only
+    # what was enabled before. Use the id the snapshot returned.
+
+    # print n.nagios.snapshot_notification_state(['redstonefoundries.com'])
+    # print n.nagios.disable_host_svc_notifications('redstonefoundries.com')
+    # print n.nagios.restore_notification_state(1)
+    # print n.nagios.list_notification_snapshots()
+    # print n.nagios.delete_notification_snapshot(1)
+
+    ##############################################
+    # OTHER EXTERNAL COMMANDS
+    ##############################################
+
+    # Any command in the module's registry can be sent with
+    # send_command, or with the method named after it. List them all
+    # with list_commands.
+
+    # print n.nagios.list_commands()
+    # print n.nagios.send_command('SCHEDULE_FORCED_SVC_CHECK', 'lnx.cx', 'HTTP', int(time.time()))
+    # print n.nagios.acknowledge_svc_problem('lnx.cx', 'HTTP', 2, 1, 1, 'func', 'Looking into it')
+    # print n.nagios.remove_svc_acknowledgement('lnx.cx', 'HTTP')
+
+    ##############################################
+    # PASSIVE CHECK RESULTS
+    ##############################################
+
+    # Submit a critical HTTP result for lnx.cx and an UP result for
+    # tbielawa.com in one batch. The second call reads results from a
+    # file on the minion, one per line in send_nsca's tab separated
+    # format.
+
+    # print n.nagios.submit_check_results([['lnx.cx', 'HTTP', 2, 'CRITICAL - connection refused'], ['tbielawa.com', 0, 'UP']])
+    # print n.nagios.submit_check_results_file('/tmp/check_results.txt')
+
+    ##############################################
+    # Several calls in one round trip, run in order. The results come
+    # back as a list. To drive many Nagios servers at once from the
+    # overlord, see nagios_client.py.
+
+    # print n.nagios.batch([['schedule_host_downtime', 'lnx.cx', 30], ['disable_host_svc_notifications', 'lnx.cx']])